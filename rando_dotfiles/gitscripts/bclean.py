@@ -1,36 +1,84 @@
-import collections
+from common import run_git, VERBOSE, branches, BranchGraph, CalledProcessError
+from common import reachability, branch_config, rewrite_branch_config
+from common import worktree_branches
+
+
+def merged_branches(graph, target):
+  """Returns the sorted branches in |graph| which are merged into |target|,
+  all found with one walk of the history (see |reachability|), rather than
+  a reachability check per branch."""
+  target_hash = graph.refs.git_hash(target)
+  hashes = dict((branch, graph.refs.hashes['refs/heads/' + branch])
+                for branch in graph.refs.branches())
+  tips = sorted(set(hashes.itervalues()).union([target_hash]))
+  try:
+    _, bits, order, masks = reachability(tips)
+  except CalledProcessError:  # unrelated histories
+    return sorted(branches('--merged', target))
+  target_bit = bits[target_hash]
+  above_base = set(order)
+  # Anything at or below the common base is in |target| too.
+  return sorted(branch for branch, h in hashes.iteritems()
+                if h not in above_base or masks[h] & target_bit)
 
-from common import run_git, VERBOSE, CalledProcessError, upstream
-from common import branches, current_branch
 
 def bclean():
-  merged = list(branches('--merged', 'origin/master'))
+  graph = BranchGraph.load()
+  merged = merged_branches(graph, 'origin/master')
 
   if VERBOSE:
     print merged
 
-  upstreams = {}
-  downstreams = collections.defaultdict(list)
-  for branch in branches():
-    try:
-      parent = upstream(branch)
-      upstreams[branch] = parent
-      downstreams[parent].append(branch)
-    except CalledProcessError:
-      pass
+  upstreams = graph.parents
+  downstreams = graph.children
 
   if VERBOSE:
     print upstreams
     print downstreams
 
-  if current_branch() in merged:
+  if graph.refs.current_branch() in merged:
     run_git('checkout', 'origin/master')
+
+  # Like `git branch -d`, leave branches checked out elsewhere alone.
+  checked_out = worktree_branches()
+  for branch in merged:
+    if branch in checked_out:
+      print 'Not deleting %s: checked out in %s' % (branch,
+                                                    checked_out[branch])
+  merged = [branch for branch in merged if branch not in checked_out]
+  merged_set = set(merged)
+
+  # Deleting a branch drops its config, and downstreams take on the upstream
+  # settings of the nearest branch above them which is staying.
+  config = branch_config()
+  changes = dict((branch, None) for branch in merged)
+  for branch in merged:
+    for down in downstreams.get(branch, ()):
+      if down in changes:
+        continue
+      source, seen = branch, set()
+      while upstreams.get(source) in merged_set and source not in seen:
+        seen.add(source)
+        source = upstreams[source]
+      settings = config.get(source, {})
+      if source not in upstreams or not ('remote' in settings and
+                                         'merge' in settings):
+        print 'Not reparenting %s: %s has no upstream' % (down, source)
+        continue
+      changes[down] = {'remote': settings['remote'],
+                       'merge': settings['merge']}
+      print ('Reparented %s to track %s (was tracking %s)'
+             % (down, upstreams[source], branch))
+
+  # One transaction, which fails as a whole if any branch has moved, in
+  # which case the config is left alone too.
+  with rewrite_branch_config(changes):
+    if merged:
+      run_git('update-ref', '--stdin', indata=''.join(
+          'delete refs/heads/%s %s\n' % (branch, graph.refs.hashes[
+              'refs/heads/' + branch]) for branch in merged))
   for branch in merged:
-    for down in downstreams[branch]:
-      if down not in merged:
-        run_git('branch', '--set-upstream-to', upstreams[branch], down)
-        print ('Reparented %s to track %s (was tracking %s)'
-               % (down, upstreams[branch], branch))
-    print run_git('branch', '-d', branch)
+    print 'Deleted branch %s (was %s).' % (
+        branch, graph.refs.hashes['refs/heads/' + branch][:7])
 
   return 0
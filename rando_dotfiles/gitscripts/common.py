@@ -9,13 +9,21 @@ def wrapper(func):
 IMapIterator.next = wrapper(IMapIterator.next)
 IMapIterator.__next__ = IMapIterator.next
 
+import collections
+import Queue
 import contextlib
+import cPickle as pickle
 import functools
+import hashlib
+import os
+import re
 import signal
 import subprocess
 import sys
 import tempfile
 import threading
+import time
+import traceback
 import binascii
 
 
@@ -94,6 +102,38 @@ def ScopedPool(*args, **kwargs):
     pool.join()
 
 
+def _run_job(fn, item):
+  try:
+    return item, fn(item), None
+  except Exception:
+    return item, None, traceback.format_exc()
+
+
+def run_jobs(pool, fn, items, done):
+  """Runs |fn| on each of |items| on |pool|, calling |done|(item, result) in
+  this thread as each one finishes.
+
+  |done| returns any new items to run, so work can be started as soon as it
+  becomes possible (or is found). Returns once nothing is left running. If
+  |fn| raises, this raises an Exception with the worker's traceback, since
+  apply_async would just drop it.
+  """
+  results = Queue.Queue()
+  outstanding = 0
+  while True:
+    for item in items:
+      pool.apply_async(_run_job, (fn, item), callback=results.put)
+      outstanding += 1
+    if not outstanding:
+      return
+    # A timeout keeps Ctrl-C working (see the IMapIterator patch above).
+    item, ret, err = results.get(True, 1e100)
+    outstanding -= 1
+    if err:
+      raise Exception('%s failed:\n%s' % (fn.__name__, err))
+    items = done(item, ret) or ()
+
+
 class StatusPrinter(object):
   """Threaded single-stat status message printer."""
   ENABLED = VERBOSE
@@ -182,8 +222,172 @@ def run_git(*cmd, **kwargs):
   return ret
 
 
+class CatFile(object):
+  """A long-lived `git cat-file --batch` (or `--batch-check`) process.
+
+  Object reads cost a pipe round-trip instead of a fork+exec. Instances are
+  thread-safe; use |cat_file| to get the shared instance for this process.
+  """
+
+  def __init__(self, check=False):
+    self.check = check
+    self._lock = threading.Lock()
+    self._proc = subprocess.Popen(
+        [GIT_EXE, 'cat-file', '--batch-check' if check else '--batch'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+
+  def query(self, reflike):
+    """Returns (hash, type, data) for |reflike|, or None if it does not name
+    exactly one object. A --batch-check reader returns the size of the object
+    in place of its data.
+    """
+    assert '\n' not in reflike
+    with self._lock:
+      self._proc.stdin.write(reflike + '\n')
+      self._proc.stdin.flush()
+      header = self._proc.stdout.readline()
+      if not header:
+        raise CalledProcessError(self._proc.wait(), 'git cat-file')
+      if header.endswith((' missing\n', ' ambiguous\n')):
+        return None
+      obj_hash, typ, size = header.split()
+      if self.check:
+        return obj_hash, typ, int(size)
+      data = self._proc.stdout.read(int(size))
+      self._proc.stdout.read(1)  # trailing LF
+      return obj_hash, typ, data
+
+  def close(self):
+    with self._lock:
+      self._proc.stdin.close()
+      self._proc.wait()
+
+
+_CAT_FILES = {}
+_CAT_FILES_LOCK = threading.Lock()
+
+def cat_file(check=False):
+  """Returns the CatFile for the current process.
+
+  Keyed by pid, so ScopedPool workers lazily start their own instead of
+  sharing the parent's pipes.
+  """
+  key = os.getpid(), check
+  with _CAT_FILES_LOCK:
+    ret = _CAT_FILES.get(key)
+    if ret is None:
+      ret = _CAT_FILES[key] = CatFile(check)
+  return ret
+
+
+def read_object(reflike, typ=None):
+  """Returns the raw contents of |reflike|, peeled to |typ| if given."""
+  if typ:
+    reflike = '%s^{%s}' % (reflike, typ)
+  ret = cat_file().query(reflike)
+  if ret is None:
+    raise CalledProcessError(128, ('cat-file', '--batch', reflike))
+  return ret[2]
+
+
+def object_hash(data, kind='blob'):
+  """Returns the hash git would give a |kind| object containing |data|."""
+  ret = hashlib.sha1('%s %d\0' % (kind, len(data)))
+  ret.update(data)
+  return ret.hexdigest()
+
+
+class HashObject(object):
+  """A long-lived `git hash-object -t <kind> -w --stdin-paths` process.
+
+  Hashes are computed in-process (see |object_hash|); the process just checks
+  and writes the objects, so a write costs a pipe round-trip instead of a
+  fork+exec. It's run with --no-filters, so that what gets written is exactly
+  what was hashed, whatever .gitattributes or core.autocrlf would do to a file
+  at the temp file's path. Use |hash_object| to get the shared instance for
+  this process.
+  """
+
+  def __init__(self, kind='blob'):
+    self.kind = kind
+    self._lock = threading.Lock()
+    self._proc = subprocess.Popen(
+        [GIT_EXE, 'hash-object', '-t', kind, '-w', '--no-filters',
+         '--stdin-paths'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+
+  def write(self, data):
+    """Writes |data| to git and returns its hash."""
+    ret = object_hash(data, self.kind)
+    with tempfile.NamedTemporaryFile(prefix='hash-object') as f, self._lock:
+      f.write(data)
+      f.flush()
+      self._proc.stdin.write(f.name + '\n')
+      self._proc.stdin.flush()
+      written = self._proc.stdout.readline().strip()
+      if written != ret:
+        raise CalledProcessError(self._proc.poll() or 1, 'git hash-object')
+    return ret
+
+  def close(self):
+    with self._lock:
+      self._proc.stdin.close()
+      self._proc.wait()
+
+
+_HASH_OBJECTS = {}
+
+def hash_object(kind='blob'):
+  """Returns the HashObject for the current process (see |cat_file|)."""
+  key = os.getpid(), kind
+  with _CAT_FILES_LOCK:
+    ret = _HASH_OBJECTS.get(key)
+    if ret is None:
+      ret = _HASH_OBJECTS[key] = HashObject(kind)
+  return ret
+
+
+@memoize_deco()
+def git_dir():
+  return run_git('rev-parse', '--git-dir')
+
+
+@memoize_deco()
+def git_common_dir():
+  """The directory with the refs and config, which is git_dir() except in
+  linked worktrees."""
+  return run_git('rev-parse', '--git-common-dir')
+
+
+def write_atomically(path, write_fn, mode='wb'):
+  """Calls |write_fn| with a temporary file (opened with |mode|) which is then
+  renamed over |path|, so |path| is never seen half-written, and is left
+  alone if |write_fn| fails."""
+  fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path),
+                             dir=os.path.dirname(path))
+  try:
+    with os.fdopen(fd, mode) as f:
+      write_fn(f)
+    os.rename(tmp, path)
+  except:
+    os.unlink(tmp)
+    raise
+
+
+class GitDirFile(object):
+  """Base class for things kept in $GIT_DIR/<FILE>, or in the git dir shared
+  by all of the worktrees if SHARED is set."""
+  FILE = None
+  SHARED = False
+
+  @classmethod
+  def path(cls):
+    return os.path.join(git_common_dir() if cls.SHARED else git_dir(),
+                        cls.FILE)
+
+
 def cat_blob(ref, f):
-  subprocess.check_call(['git', 'cat-file', 'blob', ref], stdout=f)
+  f.write(read_object(ref, 'blob'))
 
 
 def abbrev(ref):
@@ -191,11 +395,14 @@ def abbrev(ref):
 
 
 def git_hash(reflike):
-  return run_git('rev-parse', reflike)
+  ret = cat_file(check=True).query(reflike)
+  if ret is None:
+    raise CalledProcessError(128, ('cat-file', '--batch-check', reflike))
+  return ret[0]
 
 
 def git_hashes(*reflikes):
-  return run_git('rev-parse', *reflikes).splitlines()
+  return map(git_hash, reflikes)
 
 
 def git_intern_f(f, kind='blob'):
@@ -204,20 +411,36 @@ def git_intern_f(f, kind='blob'):
   return ret
 
 
+def parse_tree(data):
+  """Yields (mode, type, ref, name) for each entry of a raw tree object."""
+  i = 0
+  while i < len(data):
+    space = data.index(' ', i)
+    nul = data.index('\0', space)
+    mode = data[i:space].zfill(6)
+    i = nul + 21
+    if mode == '040000':
+      typ = 'tree'
+    elif mode == '160000':
+      typ = 'commit'
+    else:
+      typ = 'blob'
+    yield mode, typ, hexlify(data[nul+1:i]), data[space+1:nul]
+
+
 def git_tree(treeish, recurse=False):
   ret = {}
-  opts = ['ls-tree', '--full-tree']
-  if recurse:
-    opts += ['-r']
-  opts.append(treeish)
   try:
-    for line in run_git(*opts).splitlines():
-      if not line:
-        continue
-      mode, typ, ref, name = line.split(None, 3)
-      ret[name] = (mode, typ, ref)
+    stack = [('', read_object(treeish, 'tree'))]
   except CalledProcessError:
     return None
+  while stack:
+    base, data = stack.pop()
+    for mode, typ, ref, name in parse_tree(data):
+      if recurse and typ == 'tree':
+        stack.append((base + name + '/', read_object(ref)))
+      else:
+        ret[base + name] = (mode, typ, ref)
   return ret
 
 
@@ -234,7 +457,97 @@ def git_mktree(treedict):
 
 
 def parents(ref):
-  return run_git('rev-parse', '%s^@' % ref).splitlines()
+  ret = []
+  for line in read_object(ref, 'commit').splitlines():
+    if not line:
+      break
+    if line.startswith('parent '):
+      ret.append(line[7:])
+  return ret
+
+
+@memoize_deco()
+def committer_ident():
+  return run_git('var', 'GIT_COMMITTER_IDENT')
+
+
+def tree_of(commit):
+  return git_hash(commit + '^{tree}')
+
+
+def make_commit(tree, parents, like):
+  """Writes a commit of |tree| with |parents| and returns its hash.
+
+  Everything else (author, message, ...) is copied from the commit |like|,
+  except that the committer is us and any signature is dropped, as rebase
+  does.
+  """
+  header, _, msg = read_object(like, 'commit').partition('\n\n')
+  lines = ['tree ' + tree] + ['parent ' + p for p in parents]
+  drop = False
+  for line in header.split('\n'):
+    if not line.startswith(' '):  # not a continuation of the previous line
+      key = line.split(' ', 1)[0]
+      drop = key in ('tree', 'parent', 'committer', 'gpgsig', 'gpgsig-sha256')
+    if not drop:
+      lines.append(line)
+      if line.startswith('author '):
+        lines.append('committer ' + committer_ident())
+  return hash_object('commit').write('\n'.join(lines) + '\n\n' + msg)
+
+
+def merge_trees(base, ours, theirs):
+  """Three-way merges the trees |ours| and |theirs| from |base|, without
+  touching the index or worktree.
+
+  Returns the merged tree's hash, or None if there are conflicts. Any other
+  merge-tree failure raises CalledProcessError.
+  """
+  if base == ours or ours == theirs:
+    return theirs
+  if base == theirs:
+    return ours
+  # This git's merge-tree can't be told the merge base, only commits to find
+  # one for, so give it a pair of commits whose only ancestor has |base|.
+  ident = committer_ident()
+  def commit(tree, parents):
+    return hash_object('commit').write(''.join(
+        ['tree %s\n' % tree] + ['parent %s\n' % p for p in parents] +
+        ['author %s\ncommitter %s\n\nmerge_trees\n' % (ident, ident)]))
+  root = commit(base, [])
+  try:
+    out = run_git('merge-tree', '--write-tree', '--no-messages',
+                  commit(ours, [root]), commit(theirs, [root]))
+  except CalledProcessError as e:
+    if e.returncode == 1:  # conflicts; anything else is a real failure
+      return None
+    raise
+  return out.split('\n', 1)[0]
+
+
+def replay(onto, start, head):
+  """Replays the (non-merge) commits in start..head on top of |onto|, like
+  `git rebase --onto onto start head`, but only writing objects.
+
+  Commits which end up empty are dropped. Returns the hash of the new head
+  commit, or None if some commit doesn't apply cleanly.
+  """
+  new, tree = onto, tree_of(onto)
+  commits = run_git('rev-list', '--reverse', '--no-merges',
+                    '%s..%s' % (start, head)).split()
+  for commit in commits:
+    merged = merge_trees(tree_of(commit + '^'), tree, tree_of(commit))
+    if merged is None:
+      return None
+    if merged != tree:
+      new, tree = make_commit(merged, [new], commit), merged
+  return new
+
+
+def squash_commit(head, base):
+  """Writes a single commit on |base| with the tree, author and message of
+  |head|, and returns its hash."""
+  return make_commit(tree_of(head), [git_hash(base)], head)
 
 
 def upstream(branch):
@@ -245,6 +558,186 @@ def upstream(branch):
     return None
 
 
+def branch_config():
+  """Returns {branch: {key: value}} for every branch.<branch>.<key> setting,
+  from one `git config` call."""
+  ret = collections.defaultdict(dict)
+  try:
+    out = run_git('config', '-z', '--get-regexp', r'^branch\.')
+  except CalledProcessError:  # there aren't any
+    return ret
+  for entry in out.split('\0'):
+    if entry:
+      key, _, value = entry.partition('\n')
+      branch, _, name = key[len('branch.'):].rpartition('.')
+      ret[branch][name] = value
+  return ret
+
+
+CONFIG_SECTION = re.compile(r'^\s*\[')
+CONFIG_BRANCH = re.compile(r'^\s*\[\s*branch\s+"((?:[^"\\]|\\.)*)"\s*\]', re.I)
+# The deprecated [branch.name] form, whose names git lowercases.
+CONFIG_LEGACY_BRANCH = re.compile(r'^\s*\[\s*branch\.([^\]\s"]+)\s*\]', re.I)
+CONFIG_KEY = re.compile(r'^\s*([A-Za-z][-A-Za-z0-9]*)\s*(?:=|$)')
+
+def config_quote(value):
+  if re.search(r'[;#"\\]|^\s|\s$', value):
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+  return value
+
+
+def config_continued(text):
+  """Returns whether the config |text| (an entry's lines so far) carries on
+  onto the next line, by ending in a backslash which isn't in a comment."""
+  quoted = False
+  i = 0
+  while i < len(text):
+    c = text[i]
+    if c == '\\':
+      if text[i+1:] == '\n':
+        return True
+      i += 2
+      continue
+    if c == '"':
+      quoted = not quoted
+    elif c in ';#' and not quoted:
+      return False
+    i += 1
+  return False
+
+
+def config_header_end(text):
+  """Returns where the section header config |text| starts with ends (just
+  past its closing ']'), as git allows a setting after it on the same line."""
+  quoted = False
+  i = text.index('[') + 1
+  while i < len(text):
+    c = text[i]
+    if c == '\\':
+      i += 2
+      continue
+    if c == '"':
+      quoted = not quoted
+    elif c == ']' and not quoted:
+      return i + 1
+    i += 1
+  return len(text)
+
+
+def config_section_branch(line):
+  """Returns the branch a [branch ...] section header is for, else None."""
+  match = CONFIG_BRANCH.match(line)
+  if match:
+    return re.sub(r'\\(.)', r'\1', match.group(1))
+  match = CONFIG_LEGACY_BRANCH.match(line)
+  return match and match.group(1).lower()
+
+
+def warn_about_other_config(branches, path):
+  """Reports settings for any of |branches| which come from somewhere other
+  than the config file at |path| (like an included file), since those can't
+  be rewritten along with it."""
+  try:
+    out = run_git('config', '-z', '--show-origin', '--get-regexp',
+                  r'^branch\.')
+  except CalledProcessError:  # there aren't any
+    return
+  fields = out.split('\0')
+  for origin, entry in zip(fields[::2], fields[1::2]):
+    key = entry.partition('\n')[0]
+    origin = origin.partition(':')[2]
+    if (key[len('branch.'):].rpartition('.')[0] in branches and
+        os.path.realpath(origin) != os.path.realpath(path)):
+      print >> sys.stderr, 'warning: %s is set in %s; leaving it alone' % (
+          key, origin)
+
+
+@contextlib.contextmanager
+def rewrite_branch_config(changes):
+  """Applies |changes| to the [branch ...] sections of the repo's config in
+  one write, rather than with a `git config` (or `git branch`) per setting.
+
+  |changes| maps branch names to None, to remove their sections, or to
+  {key: value} settings to replace or add. Like git, this writes the new
+  config to config.lock (which also keeps other writers out meanwhile), but
+  it's only renamed into place once the with block finishes without an
+  exception, so the block's own changes and the config's go together.
+  """
+  if not changes:
+    yield
+    return
+  settings = dict(
+      (branch, dict((k.lower(), (k, v)) for k, v in values.iteritems()))
+      for branch, values in changes.iteritems() if values is not None)
+  written = set()
+  out = []
+
+  def setting_line(branch, key):
+    written.add((branch, key))
+    name, value = settings[branch][key]
+    return '\t%s = %s\n' % (name, config_quote(value))
+
+  def finish_section(branch):
+    for key in sorted(settings.get(branch, ())):
+      if (branch, key) not in written:
+        out.append(setting_line(branch, key))
+
+  path = os.path.join(git_common_dir(), 'config')
+  warn_about_other_config(changes, path)
+  lock = path + '.lock'
+  fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+  try:
+    # Work with whole entries, with any backslash-continued lines joined on.
+    entries = []
+    with open(path) as f:
+      for line in f:
+        line = line if line.endswith('\n') else line + '\n'
+        if entries and config_continued(entries[-1]):
+          entries[-1] += line
+        else:
+          entries.append(line)
+    branch = None
+    dropping = False
+    for entry in entries:
+      if CONFIG_SECTION.match(entry):
+        finish_section(branch)
+        end = config_header_end(entry)
+        branch = config_section_branch(entry[:end])
+        dropping = branch in changes and changes[branch] is None
+        if branch not in settings or not CONFIG_KEY.match(entry[end:]):
+          if not dropping:
+            out.append(entry)
+          continue
+        # Split off the setting after the header, to rewrite it like the rest.
+        out.append(entry[:end] + '\n')
+        entry = entry[end:]
+      if branch in settings:
+        match = CONFIG_KEY.match(entry)
+        key = match and match.group(1).lower()
+        if key in settings[branch]:
+          if (branch, key) in written:  # drop any other values it had
+            continue
+          entry = setting_line(branch, key)
+      if not dropping:
+        out.append(entry)
+    finish_section(branch)
+    for branch in sorted(settings):
+      if any((branch, key) not in written for key in settings[branch]):
+        out.append('[branch "%s"]\n'
+                   % branch.replace('\\', '\\\\').replace('"', '\\"'))
+        finish_section(branch)
+    with os.fdopen(fd, 'w') as f:
+      fd = None
+      f.writelines(out)
+    yield
+    os.rename(lock, path)
+  except:
+    if fd is not None:
+      os.close(fd)
+    os.unlink(lock)
+    raise
+
+
 def branches(*args):
   for line in run_git('branch', *args).splitlines():
     if line.startswith(NO_BRANCH):
@@ -263,34 +756,395 @@ def current_branch():
   return abbrev('HEAD')
 
 
+def worktree_branches():
+  """Returns {branch: worktree path} for the branches checked out anywhere."""
+  ret = {}
+  for block in run_git('worktree', 'list', '--porcelain').split('\n\n'):
+    fields = dict(line.partition(' ')[::2] for line in block.splitlines())
+    if fields.get('branch', '').startswith('refs/heads/'):
+      ret[fields['branch'][len('refs/heads/'):]] = fields.get('worktree')
+  return ret
+
+
+class RefSnapshot(object):
+  """A point-in-time view of all branches, remote branches and tags.
+
+  Everything is loaded with a single `git for-each-ref`, so the per-branch
+  queries below are answered from memory. The snapshot does not notice refs
+  changing underneath it; make a new one after moving refs around.
+  """
+  # In the order rev-parse uses to disambiguate a short name.
+  PREFIXES = ('refs/tags/', 'refs/heads/', 'refs/remotes/')
+  FIELDS = ('refname', 'HEAD', 'objectname', '*objectname', 'upstream',
+            'committerdate:raw')
+
+  def __init__(self):
+    self.hashes = {}     # full refname -> hash
+    self.peeled = {}     # full refname -> commit, for annotated tags
+    self.dates = {}      # full refname -> commit time, for refs to commits
+    self.upstreams = {}  # branch -> upstream, in the form |upstream| returns
+    self.branch_list = []
+    self.current = 'HEAD'
+
+    upstream_refs = {}
+    fmt = '%00'.join('%%(%s)' % f for f in self.FIELDS)
+    for line in run_git('for-each-ref', '--format=' + fmt,
+                        *self.PREFIXES).splitlines():
+      refname, head, obj, peeled, up, date = line.split('\0')
+      self.hashes[refname] = obj
+      if peeled:
+        self.peeled[refname] = peeled
+      if date:
+        self.dates[refname] = int(date.split()[0])
+      if refname.startswith('refs/heads/'):
+        branch = refname[len('refs/heads/'):]
+        self.branch_list.append(branch)
+        if up:
+          upstream_refs[branch] = up
+        if head == '*':
+          self.current = branch
+    # An upstream which is gone (e.g. pruned after being deleted on the
+    # remote) counts as no upstream at all, as it has nothing to rebase onto.
+    for branch, up in upstream_refs.iteritems():
+      if up in self.hashes:
+        self.upstreams[branch] = self.shorten(up)
+
+  @classmethod
+  def shorten(cls, refname):
+    for prefix in cls.PREFIXES:
+      if refname.startswith(prefix):
+        return refname[len(prefix):]
+    return refname
+
+  def branches(self):
+    return iter(self.branch_list)
+
+  def upstream(self, branch):
+    return self.upstreams.get(branch)
+
+  def current_branch(self):
+    return self.current
+
+  def git_hash(self, reflike):
+    """Like |git_hash|, but answers plain ref names from the snapshot."""
+    if reflike == 'HEAD' and self.current != 'HEAD':
+      reflike = self.current
+    for name in [reflike] + [p + reflike for p in self.PREFIXES]:
+      ret = self.hashes.get(name)
+      if ret is not None:
+        return ret
+    return git_hash(reflike)
+
+  def commit_time(self, ref):
+    """Returns the committer time (in seconds since the epoch) of the commit
+    |ref| (a ref name) points at, or None if it isn't one in the snapshot."""
+    for name in [ref] + [p + ref for p in self.PREFIXES]:
+      ret = self.dates.get(name)
+      if ret is not None:
+        return ret
+    return None
+
+
+class MergeBaseCache(GitDirFile):
+  """The merge bases recorded for branches, keyed by the branch's hash.
+
+  They live in gitscripts_merge_bases in the common git dir (as branches are
+  shared by all of the worktrees) as "<branch hash> <base>" lines. Keying on
+  the hash means a recorded base stops applying as soon as the branch moves.
+  """
+  FILE = 'gitscripts_merge_bases'
+  SHARED = True
+
+  def __init__(self):
+    self.bases = {}
+    try:
+      with open(self.path()) as f:
+        for line in f:
+          branch_hash, base = line.split()
+          self.bases[branch_hash] = base
+    except IOError:
+      pass
+
+  def save(self):
+    if not self.bases:
+      self.clear()
+      return
+    write_atomically(self.path(), lambda f: f.writelines(
+        '%s %s\n' % item for item in sorted(self.bases.iteritems())))
+
+  @classmethod
+  def clear(cls):
+    try:
+      os.unlink(cls.path())
+    except OSError:
+      pass
+
+
 def clean_refs():
-  run_git('tag', '-d',
-          *[t.strip() for t in run_git('tag', '-l', 'gitscripts.*').split()])
+  """Forgets all the recorded merge bases."""
+  MergeBaseCache.clear()
 
 
-MERGE_BASE_TAG_FMT = "gitscripts.merge_base_for_%s"
+def clean_legacy_refs():
+  """Removes the gitscripts.* tags which merge bases used to be kept in."""
+  tags = run_git('for-each-ref', '--format=%(refname:short)',
+                 'refs/tags/gitscripts.*').split()
+  if tags:
+    run_git('tag', '-d', *tags)
 
 
-def manual_merge_base_tag(branch, base):
-  tag = "gitscripts.merge_base_for_%s" % git_hash(branch)
-  run_git('tag', '-f', '-m', tag, tag, git_hash(base))
+def set_merge_base(branch, base):
+  cache = MergeBaseCache()
+  cache.bases[git_hash(branch)] = git_hash(base)
+  cache.save()
 
 
-def nuke_merge_base_tag(branch):
-  tag = "gitscripts.merge_base_for_%s" % git_hash(branch)
-  run_git('tag', '-d', tag)
+def remove_merge_base(branch):
+  """Returns False if there was no merge base recorded for |branch|."""
+  cache = MergeBaseCache()
+  if cache.bases.pop(git_hash(branch), None) is None:
+    return False
+  cache.save()
+  return True
 
 
-def get_or_create_merge_base_tag(branch, parent):
-  tag = MERGE_BASE_TAG_FMT % git_hash(branch)
-  tagval = None
+def reachability(tips):
+  """Walks the history above the merge base of all the commit hashes |tips|,
+  marking each commit with which tips it is reachable from.
+
+  Returns (base, bits, order, masks): that merge base, {tip: its bit}, the
+  commits above the base in topological order (children first), and
+  {commit: bitmask}. Everything at or below the base is reachable from every
+  tip. Raises CalledProcessError if the tips share no history.
+  """
+  base = run_git('merge-base', '--octopus', *tips)
+  bits = dict((tip, 1 << i) for i, tip in enumerate(tips))
+  masks = {}
+  order = []
+  walk = run_git('rev-list', '--topo-order', '--parents', '^' + base, *tips)
+  for line in walk.splitlines():
+    toks = line.split()
+    commit = toks[0]
+    mask = masks.get(commit, 0) | bits.get(commit, 0)
+    masks[commit] = mask
+    order.append(commit)
+    for parent in toks[1:]:
+      masks[parent] = masks.get(parent, 0) | mask
+  return base, bits, order, masks
+
+
+def merge_bases(pairs):
+  """Returns {(a, b): merge base hash} for the (a, b) commit-ish |pairs|.
+
+  Rather than a `git merge-base` per pair, this does one walk of the history
+  (see |reachability|). Walking in topological order (children first), the
+  first commit reachable from both of a pair is their merge base. Pairs with
+  no such commit above the common base have that base as theirs.
+  """
+  hashes = dict((x, git_hash(x)) for pair in pairs for x in pair)
+  tips = sorted(set(hashes.itervalues()))
   try:
-    tagval = git_hash(tag)
-    if VERBOSE:
-      print 'Found tagged merge-base for %s: %s' % (branch, tagval)
-  except CalledProcessError:
-    pass
-  if not tagval:
-    run_git('tag', '-m', tag, tag, run_git('merge-base', parent, branch))
-    tagval = git_hash(tag)
-  return tagval+'^{}'  # this lets rev-parse know this is actually a tag
+    base, bits, order, masks = reachability(tips)
+  except CalledProcessError:  # unrelated histories; nothing to share
+    return dict((pair, run_git('merge-base', *pair)) for pair in pairs)
+  ret = {}
+  for a, b in pairs:
+    need = bits[hashes[a]] | bits[hashes[b]]
+    ret[(a, b)] = next((c for c in order if masks[c] & need == need), base)
+  return ret
+
+
+def get_or_create_merge_bases(pairs):
+  """Returns {branch: merge base hash} for the (branch, parent) |pairs|.
+
+  Recorded merge bases are used where there are any; the rest are computed
+  and recorded, all with one read and one write of the MergeBaseCache.
+  """
+  cache = MergeBaseCache()
+  ret = {}
+  missing = {}
+  for branch, parent in pairs:
+    branch_hash = git_hash(branch)
+    base = cache.bases.get(branch_hash)
+    if base is None:
+      missing[branch] = (parent, branch_hash)
+    else:
+      if VERBOSE:
+        print 'Found recorded merge-base for %s: %s' % (branch, base)
+      ret[branch] = base
+  if missing:
+    bases = merge_bases(missing.values())
+    for branch, pair in missing.iteritems():
+      ret[branch] = cache.bases[pair[1]] = bases[pair]
+    cache.save()
+  return ret
+
+
+def get_or_create_merge_base(branch, parent):
+  return get_or_create_merge_bases([(branch, parent)])[branch]
+
+
+class AheadBehindCache(GitDirFile):
+  """Ahead/behind counts already worked out, keyed by the (branch hash,
+  upstream hash) they're for, so a pair is only counted again once one side
+  of it moves.
+
+  They live in $GIT_DIR/gitscripts_ahead_behind as
+  "<branch hash> <upstream hash> <ahead> <behind>" lines.
+  """
+  FILE = 'gitscripts_ahead_behind'
+
+  def __init__(self):
+    self.counts = {}
+    try:
+      with open(self.path()) as f:
+        for line in f:
+          branch_hash, upstream_hash, ahead, behind = line.split()
+          self.counts[(branch_hash, upstream_hash)] = (int(ahead), int(behind))
+    except IOError:
+      pass
+
+  def save(self):
+    write_atomically(self.path(), lambda f: f.writelines(
+        '%s %s %d %d\n' % (pair + counts)
+        for pair, counts in sorted(self.counts.iteritems())))
+
+
+def ahead_behind_counts(pairs):
+  """Returns {(a, b): (ahead, behind)} for the (a, b) commit-ish |pairs|: the
+  number of commits in a but not in b, and in b but not in a.
+
+  Like |merge_bases|, this is one walk for all the pairs, rather than a
+  `git rev-list --count` each. Commits below the common base are in
+  everything, so only the ones above it need counting, and those are counted
+  by which tips they're reachable from rather than one by one.
+  """
+  hashes = dict((x, git_hash(x)) for pair in pairs for x in pair)
+  tips = sorted(set(hashes.itervalues()))
+  try:
+    _, bits, order, masks = reachability(tips)
+  except CalledProcessError:  # unrelated histories
+    ret = {}
+    for a, b in pairs:
+      counts = run_git('rev-list', '--left-right', '--count',
+                       '%s...%s' % (a, b)).split()
+      ret[(a, b)] = tuple(map(int, counts))
+    return ret
+  by_mask = collections.Counter(masks[c] for c in order)
+  ret = {}
+  for a, b in pairs:
+    a_bit, b_bit = bits[hashes[a]], bits[hashes[b]]
+    ahead = behind = 0
+    for mask, count in by_mask.iteritems():
+      if mask & a_bit and not mask & b_bit:
+        ahead += count
+      elif mask & b_bit and not mask & a_bit:
+        behind += count
+    ret[(a, b)] = (ahead, behind)
+  return ret
+
+
+class BranchGraph(GitDirFile):
+  """The trees of branches and the upstreams they track.
+
+  Built from one RefSnapshot (|refs|), and cached on disk in
+  $GIT_DIR/gitscripts_branch_graph until any of the files and directories
+  refs and upstreams live in changes. Get one with BranchGraph.load().
+
+    parents:  {branch: upstream}, for the branches which track something.
+    children: {name: [branches tracking it]}, sorted.
+    roots:    the sorted names at the tops of the trees: upstreams which don't
+              track anything themselves (like origin/master), and branches
+              which don't track anything.
+    depth:    {name: how far below its root it is}.
+  """
+  FILE = 'gitscripts_branch_graph'
+  # Bump this when the pickled form changes, so older caches get rebuilt.
+  VERSION = 4
+
+  def __init__(self, refs=None):
+    self.version = self.VERSION
+    self.refs = refs or RefSnapshot()
+    self.parents = dict(self.refs.upstreams)
+    self.children = {}
+    for branch, parent in sorted(self.parents.iteritems()):
+      self.children.setdefault(parent, []).append(branch)
+    self.roots = sorted(name for name in
+                        set(self.children).union(self.refs.branches())
+                        if name not in self.parents)
+    self.depth = {}
+    todo = [(root, 0) for root in self.roots]
+    for name, depth in todo:
+      self.depth[name] = depth
+      todo.extend((child, depth+1) for child in self.children.get(name, ()))
+    self._ahead_behind = None
+
+  def ahead_behind(self):
+    """Returns {branch: (ahead, behind)} for each branch against its upstream
+    (see |ahead_behind_counts|). Branches whose upstreams are gone are left
+    out.
+
+    Only pairs of commits missing from the AheadBehindCache are counted, and
+    the cache is left holding just the pairs which are current.
+    """
+    if self._ahead_behind is None:
+      pairs = {}
+      for branch, parent in self.parents.iteritems():
+        try:
+          pairs[branch] = (self.refs.git_hash(branch),
+                           self.refs.git_hash(parent))
+        except CalledProcessError:
+          continue
+      cache = AheadBehindCache()
+      current = set(pairs.itervalues())
+      missing = current.difference(cache.counts)
+      if missing:
+        cache.counts.update(ahead_behind_counts(list(missing)))
+      if missing or len(cache.counts) != len(current):
+        cache.counts = dict((pair, cache.counts[pair]) for pair in current)
+        cache.save()
+      self._ahead_behind = dict((branch, cache.counts[pair])
+                                for branch, pair in pairs.iteritems())
+    return self._ahead_behind
+
+  @staticmethod
+  def stamp():
+    """Returns the mtimes of HEAD, packed-refs, config and every directory of
+    loose refs, which between them change whenever a ref or upstream does.
+
+    Only HEAD belongs to the worktree; the rest are shared by all of them.
+    """
+    common = git_common_dir()
+    paths = [os.path.join(git_dir(), 'HEAD')]
+    paths.extend(os.path.join(common, name)
+                 for name in ('packed-refs', 'config'))
+    for path, _, _ in os.walk(os.path.join(common, 'refs')):
+      paths.append(path)
+    ret = []
+    for path in paths:
+      try:
+        ret.append((path, os.stat(path).st_mtime))
+      except OSError:
+        ret.append((path, None))
+    return ret
+
+  @classmethod
+  def load(cls):
+    """Returns the cached BranchGraph, first rebuilding it if anything has
+    changed since it was built."""
+    stamp = cls.stamp()
+    try:
+      with open(cls.path(), 'rb') as f:
+        cached_stamp, built, graph = pickle.load(f)
+      # Like the index, don't trust anything modified around when the cache
+      # was built; it may have changed again within the same mtime.
+      if (graph.version == cls.VERSION and cached_stamp == stamp and
+          all(mtime < built - 1 for _, mtime in stamp if mtime)):
+        return graph
+    except Exception:  # missing, or from an older version of this class
+      pass
+    built = time.time()
+    graph = cls()
+    write_atomically(cls.path(), lambda f: pickle.dump(
+        (stamp, built, graph), f, pickle.HIGHEST_PROTOCOL))
+    return graph
@@ -1,17 +1,19 @@
 #!/usr/bin/env python
 import sys
 
-from common import current_branch, branches, upstream, run_git, git_hash
+from common import run_git, BranchGraph
 
 
 def main(argv):
   assert len(argv) == 1, "No arguments expected"
-  upfn = upstream
-  cur = current_branch()
+  graph = BranchGraph.load()
+  cur = graph.refs.current_branch()
   if cur == 'HEAD':
-    upfn = lambda b: git_hash(upstream(b))
-    cur = git_hash(cur)
-  downstreams = [b for b in branches() if upfn(b) == cur]
+    cur = graph.refs.git_hash(cur)
+    downstreams = sorted(b for b, up in graph.parents.iteritems()
+                         if graph.refs.git_hash(up) == cur)
+  else:
+    downstreams = graph.children.get(cur, [])
   if not downstreams:
     return "No downstream branches"
   elif len(downstreams) == 1:
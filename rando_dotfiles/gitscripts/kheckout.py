@@ -1,22 +1,63 @@
 #!/usr/bin/env python
 
+import errno
+import fcntl
+import hashlib
+import marshal
 import multiprocessing
 import os
 import pygit2
 import shutil
+import struct
+import subprocess
 import sys
+import time
 
-from common import parse_one_committish, hexlify, ScopedPool, git_tree
-from common import run_git, CalledProcessError, StatusPrinter
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+from common import parse_one_committish, hexlify, unhexlify, ScopedPool
+from common import git_tree, run_jobs, write_atomically
+from common import run_git, CalledProcessError, StatusPrinter, git_dir
+from common import git_hash, read_object, parse_tree, cat_file, GIT_EXE
 
 
 FMT = "Checked out %%d/%d files"
 PROC_COUNT = multiprocessing.cpu_count()
-FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL
 if sys.platform.startswith('win'):
   FLAGS |= os.O_BINARY
 REPO = None
 TREE_ROOT = None
+# $GIT_DIR/kheckout.stat remembers which tree the worktree was last checked
+# out to, and the lstat of every file kheckout placed or verified, as
+# {path: (filemode, ref) + <stat_key(path)>}. See load_stats. It's also
+# everything needed to write the index (see write_index). Directories which
+# force_checkout wrote out are in there too, as '<path>/' (the top is '/'),
+# so nuke_extras can tell which ones nothing has been added to since.
+STAT_FILE = 'kheckout.stat'
+TREE_MODE = 040000
+# ctime s, ns, mtime s, ns, dev, ino, mode, uid, gid, size, sha1, flags
+INDEX_ENTRY_FMT = '!10L20sH'
+INDEX_ENTRY_SIZE = struct.calcsize(INDEX_ENTRY_FMT)
+# Roughly how many files a worker places per task. Big enough that dispatch
+# overhead vanishes, small enough that every worker stays busy to the end.
+TASK_FILES = 2048
+WRITE_CHUNK = 1 << 20
+# Blobs bigger than this are streamed from `git cat-file` instead of being
+# read into memory whole.
+STREAM_SIZE = 32 << 20
+# Blobs at least this big which a worker has already placed are reflinked
+# from that copy (where the filesystem supports it) instead of rewritten.
+CLONE_SIZE = 64 << 10
+FICLONE = 0x40049409  # _IOW(0x94, 9, int), from linux/fs.h
+CAN_CLONE = sys.platform.startswith('linux')
+PLACED = {}  # {ref: path} of the big blobs this worker has placed
 
 
 def init_repo():
@@ -40,15 +81,68 @@ def mode_hex(path):
     return None, None
 
 
+def write_all(fd, data):
+  """os.write can write less than it's given (especially for big buffers)."""
+  off = 0
+  while off < len(data):
+    off += os.write(fd, buffer(data, off, WRITE_CHUNK))
+
+
+def stream_blob(fd, ref):
+  proc = subprocess.Popen([GIT_EXE, 'cat-file', 'blob', ref],
+                          stdout=subprocess.PIPE)
+  for chunk in iter(lambda: proc.stdout.read(WRITE_CHUNK), ''):
+    write_all(fd, chunk)
+  if proc.wait():
+    raise CalledProcessError(proc.returncode, 'git cat-file blob %s' % ref)
+
+
+def clone_file(fd, src):
+  """Makes |fd| a reflink copy of the file |src|. Returns False if that
+  isn't possible, in which case |fd| is untouched."""
+  global CAN_CLONE
+  try:
+    src_fd = os.open(src, os.O_RDONLY)
+  except OSError:
+    return False
+  try:
+    fcntl.ioctl(fd, FICLONE, src_fd)
+    return True
+  except (IOError, OSError) as e:
+    if e.errno in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY):
+      CAN_CLONE = False
+    return False
+  finally:
+    os.close(src_fd)
+
+
 def place_file(path, mode, ref):
+  """Writes blob |ref| to |path| with permissions |mode|.
+
+  The blob goes to a temporary file next to |path| (created with |mode|) which
+  is then renamed over it, so |path| is never seen half-written.
+  """
+  tmp = '%s.kheckout-%d' % (path, os.getpid())
   try:
-    fd = os.open(path, FLAGS, mode)
-    d = REPO[ref].data
-    os.write(fd, d)
-    os.close(fd)
-    os.chmod(path, mode)
+    size = cat_file(check=True).query(ref)[2]
+    fd = os.open(tmp, FLAGS, mode)
+    try:
+      src = PLACED.get(ref) if CAN_CLONE and size >= CLONE_SIZE else None
+      if src and clone_file(fd, src):
+        pass
+      elif size > STREAM_SIZE:
+        stream_blob(fd, ref)
+      else:
+        write_all(fd, REPO[ref].data)
+    finally:
+      os.close(fd)
+    os.rename(tmp, path)
+    if size >= CLONE_SIZE:
+      PLACED[ref] = path
   except Exception as e:
     print e
+    if os.path.lexists(tmp):
+      os.unlink(tmp)
 
 
 def place_link(path, ref):
@@ -58,8 +152,12 @@ def place_link(path, ref):
 
 
 def make_dir(path):
-  if not os.path.exists(path):
-    os.makedirs(path)
+  if not os.path.isdir(path):
+    try:
+      os.makedirs(path)
+    except OSError:  # another worker got there first
+      if not os.path.isdir(path):
+        raise
 
 
 def fix_head(target):
@@ -75,6 +173,89 @@ def handle_file_lookup(path):
   handle_file(path, *mode_hex(path))
 
 
+def stat_key(path):
+  """Returns what we remember about |path| to tell if it has changed, which
+  is also everything an index entry needs."""
+  st = os.lstat(path)
+  return (st.st_size, st.st_mtime, st.st_ino, st.st_ctime, st.st_dev,
+          st.st_uid, st.st_gid)
+
+
+def is_submodule(filemode):
+  return filemode >> (3*3) == 0160
+
+
+def dir_key(d):
+  return d + '/'
+
+
+def place_entry(path, filemode, ref):
+  """Places |path| and returns (path, <stats entry for it>), for ScopedPool
+  callbacks to collect."""
+  handle_file(path, filemode, ref)
+  if is_submodule(filemode):  # nothing of ours to stat in a submodule
+    return path, (filemode, ref)
+  try:
+    return path, (filemode, ref) + stat_key(path)
+  except OSError:  # place_file already complained
+    return path, (filemode, ref)
+
+
+def place_entries(jobs):
+  """Places every (path, filemode, ref) in |jobs|.
+
+  Returns ({path: <stats entry>}, []), like place_subtrees.
+  """
+  stats = {}
+  for path, filemode, ref in jobs:
+    d = os.path.dirname(path)
+    if d:
+      make_dir(d)
+    stats[path] = place_entry(path, filemode, ref)[1]
+  return stats, []
+
+
+def place_subtrees(todo):
+  """Writes out the trees in |todo|, a list of (tree ref, directory), by
+  walking them in this worker.
+
+  Stops once about TASK_FILES files have been placed, and hands back the
+  subtrees it didn't get to so they can be spread over the other workers.
+  Returns ({path: <stats entry>}, <leftover todo>).
+  """
+  stats = {}
+  while todo and len(stats) < TASK_FILES:
+    ref, d = todo.pop()
+    make_dir(d)
+    for ent in REPO[ref]:
+      path = os.path.join(d, ent.name)
+      if ent.filemode == TREE_MODE:
+        # Made now so that |d| is done changing when we stat it below.
+        make_dir(path)
+        todo.append((ent.hex, path))
+      else:
+        stats[path] = place_entry(path, ent.filemode, ent.hex)[1]
+    stats[dir_key(d)] = (TREE_MODE, ref) + stat_key(d)
+  return stats, todo
+
+
+def run_task(task):
+  fn, todo = task
+  return fn(todo)
+
+
+def run_tasks(pool, tasks, stats, inc):
+  """Runs (fn, todo) |tasks| on |pool| until they're all done, feeding their
+  leftovers back in as new tasks (one per leftover subtree) and merging
+  their results into |stats|."""
+  def task_done(_task, (done, leftover)):
+    stats.update(done)
+    inc(sum(1 for path in done if not path.endswith('/')))
+    return [(place_subtrees, [item]) for item in leftover]
+
+  run_jobs(pool, run_task, tasks, task_done)
+
+
 def handle_file(path, filemode, ref):
   if ref is None:
     kill_it(path)
@@ -99,43 +280,278 @@ def handle_dir(made_dirs, path):
     made_dirs.add(d)
 
 
-def nuke_extras(all_files):
-  for dirpath, dirnames, filenames in os.walk('.'):
-    if dirpath.endswith('.git'):
-      dirnames[:] = []
-      continue
-    elif dirpath != '' and '.git' in dirnames:
-      dirnames[:] = []
+def list_dir(d):
+  """Yields (name, is a real directory) for everything in |d|."""
+  if scandir:
+    for ent in scandir(d or '.'):
+      yield ent.name, ent.is_dir(follow_symlinks=False)
+  else:
+    for name in os.listdir(d or '.'):
+      path = os.path.join(d, name)
+      yield name, os.path.isdir(path) and not os.path.islink(path)
+
+
+def nuke_dir(ref, d, dirs):
+  """Removes whatever is in directory |d| but not in the tree |ref|.
+
+  That listing is skipped if |d| has the same tree and stat as it did in
+  |dirs| (see STAT_FILE), since then nothing can have been added to it.
+  Returns (<removed paths>, <(ref, dir) of the subdirectories to check>).
+  """
+  ents = dict((ent.name, ent) for ent in REPO[ref])
+  removed = []
+  old = dirs.get(dir_key(d))
+  if not old or old[1] != ref or stats_changed(d or '.', old):
+    for name, is_dir in list_dir(d):
+      path = os.path.join(d, name)
+      ent = ents.get(name)
+      if ent is None:
+        if not d and name == '.git':
+          continue
+        if is_dir and os.path.exists(os.path.join(path, '.git')):
+          continue  # someone else's repo
+      elif is_dir == (ent.filemode in (TREE_MODE, 0160000)):
+        continue
+      kill_it(path)
+      removed.append(path)
+  return removed, [(ent.hex, os.path.join(d, name))
+                   for name, ent in ents.iteritems()
+                   if ent.filemode == TREE_MODE]
+
+
+def nuke_extras(job):
+  """Runs nuke_dir over the tree |ref| checked out at |d|, in a worker.
+  Returns the removed paths."""
+  ref, d, dirs = job
+  removed = []
+  todo = [(ref, d)]
+  while todo:
+    ref, d = todo.pop()
+    if os.path.isdir(d):
+      gone, subdirs = nuke_dir(ref, d, dirs)
+      removed.extend(gone)
+      todo.extend(subdirs)
+  return removed
+
+
+def force_checkout(target):
+  new_tree = git_hash(target + '^{tree}')
+  old_stats = load_stats()[1]
+  stats = {}
+  with StatusPrinter('Removed %d extras') as inc:
+    with ScopedPool(PROC_COUNT, initializer=init_repo) as pool:
+      removed, subdirs = pool.apply(
+          nuke_dir, (new_tree, '', {dir_key(''): old_stats.get(dir_key(''))}))
+      # One job per top-level directory, each with the stats of just the
+      # directories under it.
+      jobs = dict((d, (ref, d, {})) for ref, d in subdirs)
+      for path, ent in old_stats.iteritems():
+        job = jobs.get(path.split('/', 1)[0])
+        if job and ent[0] == TREE_MODE:
+          job[2][path] = ent
+      inc(len(removed))
+      for gone in pool.imap_unordered(nuke_extras, jobs.values()):
+        removed.extend(gone)
+        inc(len(gone))
+  for path in sorted(removed):
+    print 'Removed %s' % path
+
+  # No total: counting the files up front would mean reading every tree
+  # here, before any of the workers could start.
+  with StatusPrinter('Checked out %d files') as inc:
+    with ScopedPool(PROC_COUNT, initializer=init_repo) as pool:
+      # Workers are handed whole subtrees to walk themselves, starting with
+      # one per top-level entry.
+      tasks = []
+      for name, (mode, ref) in tree_entries(new_tree).iteritems():
+        if int(mode, 8) == TREE_MODE:
+          tasks.append((place_subtrees, [(ref, name)]))
+        else:
+          tasks.append((place_entries, [(name, int(mode, 8), ref)]))
+      run_tasks(pool, tasks, stats, inc)
+  stats[dir_key('')] = (TREE_MODE, new_tree) + stat_key('.')
+  save_stats(new_tree, stats)
+  write_index(stats)
+
+
+def kill_it(path):
+  if os.path.isdir(path) and not os.path.islink(path):
+    shutil.rmtree(path)
+  elif os.path.lexists(path):
+    os.unlink(path)
+
+
+def load_stats():
+  """Returns (tree, stats) as saved by save_stats, or (None, {})."""
+  try:
+    with open(os.path.join(git_dir(), STAT_FILE), 'rb') as f:
+      tree, stamp, stats = marshal.load(f)
+  except (IOError, EOFError, ValueError, TypeError):
+    return None, {}
+  # A file modified within the same clock tick as it was stat'd can't be told
+  # apart from the version we saw, so distrust anything that recent. Some
+  # filesystems only keep whole seconds.
+  for path, ent in stats.items():
+    if len(ent) > 3 and ent[3] >= int(stamp):
+      stats[path] = ent[:2]
+  return tree, stats
+
+
+def save_stats(tree, stats):
+  write_atomically(os.path.join(git_dir(), STAT_FILE),
+                   lambda f: marshal.dump((tree, time.time(), stats), f))
+
+
+def split_time(t):
+  sec = int(t)
+  return sec, int((t - sec) * 1e9)
+
+
+def write_index(stats):
+  """Writes the index straight from |stats| (see STAT_FILE), so it lists
+  exactly the files we know of, stat data and all, and `git status` has
+  nothing to refresh.
+
+  Entries without stat data get zeros, which git will rehash.
+  """
+  index = os.path.join(git_dir(), 'index')
+  lock = index + '.lock'
+  fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      sha = hashlib.sha1()
+      def write(data):
+        sha.update(data)
+        f.write(data)
+      paths = sorted(path for path, ent in stats.iteritems()
+                     if ent[0] != TREE_MODE)
+      write(struct.pack('!4sLL', 'DIRC', 2, len(paths)))
+      for path in paths:
+        ent = stats[path]
+        filemode, ref = ent[:2]
+        if len(ent) > 2:
+          size, mtime, ino, ctime, dev, uid, gid = ent[2:]
+        else:
+          size = mtime = ino = ctime = dev = uid = gid = 0
+        # The padding brings each entry to a multiple of 8 bytes, and always
+        # includes at least one NUL to end the path.
+        pad = 8 - (INDEX_ENTRY_SIZE + len(path)) % 8
+        write(struct.pack(INDEX_ENTRY_FMT, *(
+            split_time(ctime) + split_time(mtime) + (
+                dev & 0xffffffff, ino & 0xffffffff, filemode, uid, gid,
+                size & 0xffffffff, unhexlify(ref), min(len(path), 0xfff))))
+              + path + '\0' * pad)
+      f.write(sha.digest())
+    os.rename(lock, index)
+  except:
+    os.unlink(lock)
+    raise
+
+
+def tree_entries(tree):
+  """Returns {name: (mode, ref)} for the hash |tree|, or {} if it's None."""
+  if tree is None:
+    return {}
+  return dict((name, (mode, ref))
+              for mode, _, ref, name in parse_tree(read_object(tree)))
+
+
+def diff_trees(old, new, base=''):
+  """Yields (path, old, new) for each path whose (mode, ref) differs between
+  the trees |old| and |new| (hashes, or None for an empty tree).
+
+  Only subtrees whose hashes differ are read, so this costs time in the size
+  of the change rather than of the trees. Subtrees are recursed into, except
+  that a path which stops being a tree is yielded once with its old entry.
+  """
+  old_ents, new_ents = tree_entries(old), tree_entries(new)
+  for name in sorted(set(old_ents) | set(new_ents)):
+    o, n = old_ents.get(name), new_ents.get(name)
+    if o == n:
       continue
+    path = base + name
+    o_tree = o is not None and o[0] == '040000'
+    n_tree = n is not None and n[0] == '040000'
+    if o_tree and n_tree:
+      for item in diff_trees(o[1], n[1], path + '/'):
+        yield item
+    elif n_tree:
+      if o is not None:
+        yield path, o, None
+      for item in diff_trees(None, n[1], path + '/'):
+        yield item
+    else:
+      yield path, o, n
 
-    for path in (os.path.join(dirpath, f) for f in filenames):
-      if path not in all_files:
-        os.unlink(path)
 
+def stats_changed(path, ent):
+  try:
+    return ent[2:] != stat_key(path)
+  except OSError:
+    return True
+
+
+def fancy_checkout(target):
+  """Makes the worktree match the tree of |target|, touching only the files
+  which differ from the previous kheckout or were modified since.
+
+  Falls back to status_checkout when there's no stat cache to go on.
+  """
+  new_tree = git_hash(target + '^{tree}')
+  old_tree, stats = load_stats()
+  if old_tree is None:
+    run_git('reset', '-q', target)
+    status_checkout()
+    record_stats(new_tree)
+    return
 
-def force_checkout(tree):
-  made_dirs = set()
-  fmt = FMT % (len(tree) + 1)
-  with StatusPrinter(fmt) as inc:
-    ign_inc = lambda *_: inc()
+  jobs = []
+  for path, o, n in diff_trees(old_tree, new_tree):
+    if o is not None and o[0] == '040000':
+      # Rare enough (a directory became a file) to just handle right here.
+      kill_it(path)
+      prefix = path + '/'
+      for p in [p for p in stats if p.startswith(prefix)]:
+        del stats[p]
+    if n is None:
+      kill_it(path)
+      stats.pop(path, None)
+    else:
+      jobs.append((path, int(n[0], 8), n[1]))
+
+  # Files which are the same in both trees still have to be put back if
+  # they were modified in the worktree since we last saw them.
+  changed = set(path for path, _, _ in jobs)
+  for path, ent in stats.iteritems():
+    if (path not in changed and ent[0] != TREE_MODE and
+        not is_submodule(ent[0]) and stats_changed(path, ent)):
+      jobs.append((path, ent[0], ent[1]))
+
+  tasks = [(place_entries, jobs[i:i+TASK_FILES])
+           for i in xrange(0, len(jobs), TASK_FILES)]
+  with StatusPrinter(FMT % len(jobs)) as inc:
     with ScopedPool(PROC_COUNT, initializer=init_repo) as pool:
-      pool.apply_async(nuke_extras, (tree,), callback=ign_inc)
+      run_tasks(pool, tasks, stats, inc)
 
-      for path, (mode, _, ref) in tree.iteritems():
-        handle_dir(made_dirs, path)
-        pool.apply_async(handle_file, (path, int(mode, 8), ref),
-                         callback=ign_inc)
+  save_stats(new_tree, stats)
+  write_index(stats)
 
 
-def kill_it(path):
-  if os.path.exists(path):
-    if os.path.isdir(path):
-      shutil.rmtree(path)
-    else:
-      os.unlink(path)
+def record_stats(tree):
+  """Records the stats of every file in |tree| (which the worktree is known
+  to match) as the stat cache."""
+  stats = {}
+  for path, (mode, typ, ref) in git_tree(tree, recurse=True).iteritems():
+    stats[path] = (int(mode, 8), ref)
+    if typ == 'blob':
+      try:
+        stats[path] += stat_key(path)
+      except OSError:
+        pass
+  save_stats(tree, stats)
 
 
-def fancy_checkout():
+def status_checkout():
   made_dirs = set()
 
   # Curiously, this is faster than REPO.status(), even on *nix.
@@ -171,12 +587,11 @@ def main():
   target = hexlify(parse_one_committish())
   print 'Got Target: %s' % target
   fix_head(target)
-  run_git('reset', '-q', target)
 
   if force:
-    force_checkout(git_tree(target, recurse=True))
+    force_checkout(target)
   else:
-    fancy_checkout()
+    fancy_checkout(target)
 
 
 if __name__ == '__main__':
@@ -1,19 +1,15 @@
 #!/usr/bin/env python
 import sys
 
-from common import nuke_merge_base_tag, manual_merge_base_tag
-from common import CalledProcessError
+from common import remove_merge_base, set_merge_base
 
 
 def main(argv):
   assert len(argv) <= 2, "Must supply merge base or no arg."
   if len(argv) == 2:
-    manual_merge_base_tag('HEAD', argv[1])
-  else:
-    try:
-      nuke_merge_base_tag('HEAD')
-    except CalledProcessError:
-      print "No merge base tag currently exists for this branch."
+    set_merge_base('HEAD', argv[1])
+  elif not remove_merge_base('HEAD'):
+    print "No merge base currently recorded for this branch."
   return 0
 
 
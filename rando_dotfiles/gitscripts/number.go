@@ -1,6 +1,32 @@
+// A Go implementation of the heavy parts of number.py.
+//
+// Build it next to number.py, where number.py will find and use it:
+//
+//	go build -o number number.go
+//
+// Run as `number [<committish>]` it prints the stored generation number of
+// <committish> (default HEAD), like `number.py` does for already numbered
+// commits.
+//
+// Run as `number -backend` it speaks a line protocol on stdin/stdout with
+// number.py, which streams rev-list to it and collects the results:
+//
+//	> B <n>            followed by n `rev-list --parents` lines, in
+//	                   topological order (parents first)
+//	< N <k>            followed by k hashes of parents which are neither in
+//	                   the batch nor pending, which number.py must number
+//	> <num>            k lines, one number per hash above
+//	< D <pending> <last>
+//	                   the batch is numbered; <pending> numbers are held and
+//	                   <last> is the number of the batch's last commit
+//
+//	> F                flush
+//	< R <bytes>        followed by every pending number as sorted "!20sL"
+//	                   records (the leaf format), after which pending is empty
 package main
 
 import (
+	"bufio"
 	"bytes"
 	"encoding/binary"
 	"encoding/hex"
@@ -10,9 +36,13 @@ import (
 	"log"
 	"os"
 	"os/exec"
+	"sort"
+	"strconv"
 	"strings"
 )
 
+const REF = "refs/number/commits"
+
 func git_output(name string, arg ...string) io.ReadCloser {
 	cmd := exec.Command("git", append([]string{name}, arg...)...)
 	out, err := cmd.StdoutPipe()
@@ -33,13 +63,112 @@ type Line struct {
 	Count uint32
 }
 
-func main() {
-	target := "HEAD"
+type Hash [20]byte
 
-	if len(os.Args) < 2 {
-		target = os.Args[1]
+func parse_hash(s string) Hash {
+	var h Hash
+	if len(s) != 40 {
+		log.Fatalf("bad hash %q", s)
+	}
+	if _, err := hex.Decode(h[:], []byte(s)); err != nil {
+		log.Fatal(err)
+	}
+	return h
+}
+
+func read_line(r *bufio.Reader) string {
+	line, err := r.ReadString('\n')
+	if err != nil {
+		log.Fatal(err)
 	}
+	return strings.TrimRight(line, "\n")
+}
+
+func backend() {
+	in := bufio.NewReaderSize(os.Stdin, 1<<20)
+	out := bufio.NewWriterSize(os.Stdout, 1<<20)
+	pending := map[Hash]uint32{}
+
+	for {
+		cmd, err := in.ReadString('\n')
+		if err == io.EOF {
+			return
+		} else if err != nil {
+			log.Fatal(err)
+		}
+		toks := strings.Fields(cmd)
+
+		switch toks[0] {
+		case "B":
+			n, _ := strconv.Atoi(toks[1])
+			commits := make([][]Hash, n)
+			need := []Hash{}
+			seen := map[Hash]bool{}
+			for i := range commits {
+				for _, tok := range strings.Fields(read_line(in)) {
+					commits[i] = append(commits[i], parse_hash(tok))
+				}
+				for _, par := range commits[i][1:] {
+					if _, ok := pending[par]; !ok && !seen[par] {
+						need = append(need, par)
+						seen[par] = true
+					}
+				}
+				seen[commits[i][0]] = true
+			}
+
+			fmt.Fprintf(out, "N %d\n", len(need))
+			for _, h := range need {
+				fmt.Fprintf(out, "%x\n", h[:])
+			}
+			out.Flush()
+			for _, h := range need {
+				num, err := strconv.ParseUint(read_line(in), 10, 32)
+				if err != nil {
+					log.Fatal(err)
+				}
+				pending[h] = uint32(num)
+			}
+
+			var last uint32
+			for _, commit := range commits {
+				last = 0
+				for i, par := range commit[1:] {
+					if num := pending[par] + 1; i == 0 || num > last {
+						last = num
+					}
+				}
+				pending[commit[0]] = last
+			}
+			// The outside parents were only needed for this batch.
+			for _, h := range need {
+				delete(pending, h)
+			}
+			fmt.Fprintf(out, "D %d %d\n", len(pending), last)
+			out.Flush()
+
+		case "F":
+			keys := make([]Hash, 0, len(pending))
+			for h := range pending {
+				keys = append(keys, h)
+			}
+			sort.Slice(keys, func(i, j int) bool {
+				return bytes.Compare(keys[i][:], keys[j][:]) < 0
+			})
+			fmt.Fprintf(out, "R %d\n", len(keys)*24)
+			for _, h := range keys {
+				binary.Write(out, binary.BigEndian, Line{h, pending[h]})
+			}
+			out.Flush()
+			pending = map[Hash]uint32{}
 
+		default:
+			log.Fatalf("unknown command %q", cmd)
+		}
+	}
+}
+
+func lookup(target string) {
 	reader := git_output("rev-parse", target)
 	out, err := ioutil.ReadAll(reader)
 	if err != nil {
@@ -53,17 +182,42 @@ func main() {
 		log.Fatal(err)
 	}
 
-	reader = git_output("cat-file", "blob", "refs/number/commits:"+hash[:2])
-
-	var line Line
-	for {
-		err = binary.Read(reader, binary.BigEndian, &line)
-		if err != nil {
-			break
+	// A leaf is a base blob plus any number of overlays named "<leaf>.<n>".
+	reader = git_output("ls-tree", "--name-only", REF)
+	names, err := ioutil.ReadAll(reader)
+	if err != nil {
+		log.Fatal(err)
+	}
+	for _, name := range strings.Fields(string(names)) {
+		if name != hash[:2] && !strings.HasPrefix(name, hash[:2]+".") {
+			continue
 		}
-		if bytes.Equal(line.Hash[:], squished) {
-			fmt.Println(line.Count)
-			break
+		reader = git_output("cat-file", "blob", REF+":"+name)
+
+		var line Line
+		for {
+			err = binary.Read(reader, binary.BigEndian, &line)
+			if err != nil {
+				break
+			}
+			if bytes.Equal(line.Hash[:], squished) {
+				fmt.Println(line.Count)
+				return
+			}
 		}
 	}
 }
+
+func main() {
+	target := "HEAD"
+
+	if len(os.Args) > 1 {
+		target = os.Args[1]
+	}
+
+	if target == "-backend" {
+		backend()
+	} else {
+		lookup(target)
+	}
+}
@@ -1,65 +1,387 @@
 #!/usr/bin/env python
 
-import collections
+import itertools
+import mmap
 import os
+import signal
+import socket
 import struct
 import subprocess
+import sys
 import tempfile
+import traceback
 
-from common import git_hash, run_git, git_intern_f, git_tree
+from cStringIO import StringIO
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from common import git_hash, run_git, git_tree, git_dir
 from common import git_mktree, StatusPrinter, hexlify, unhexlify, pathlify
-from common import parse_one_committish, ScopedPool, memoize_deco
+from common import parse_one_committish, memoize_deco, cat_file, hash_object
+from common import CalledProcessError, write_atomically
 
 
 CHUNK_FMT = '!20sL'
 CHUNK_SIZE = struct.calcsize(CHUNK_FMT)
-DIRTY_TREES = collections.defaultdict(int)
 REF = 'refs/number/commits'
 PREFIX_LEN = 1
+# Each leaf of REF is a sorted base blob named by its prefix path plus up to
+# this many small sorted overlay blobs ('<path>.1', '<path>.2', ...) holding
+# numbers added since the base was written. finalize adds one overlay per
+# dirty leaf, and folds everything back into the base once this is reached.
+OVERLAY_LIMIT = 8
+
+# How many new numbers resolve keeps in memory before spilling them to a
+# sorted run on disk. Runs are merged back into leaves by finalize.
+SPILL_SIZE = 1 << 18
+SPILLS = []  # mmapped, sorted CHUNK_FMT runs of spilled numbers
+# rev-list is read and numbered this many commits at a time.
+BATCH_SIZE = 1 << 16
+# generations() only uses numpy while at least this many commits at a time
+# are ready to be numbered; narrower waves are cheaper in plain python.
+MIN_WAVE = 256
+
+SOCKET_FILE = 'number.sock'
+
+CACHE_FILE = 'number.cache'
+CACHE_MAGIC = 'GNC1'
+# magic, fanout bits, commit of REF the cache was built from, record count
+CACHE_HEADER_FMT = '!4sB20sL'
+CACHE_HEADER_SIZE = struct.calcsize(CACHE_HEADER_FMT)
+DEFAULT_FANOUT_BITS = 8
+
 
 @memoize_deco()
-def get_num_tree(prefix_bytes):
-  """Return a dictionary of the blob contents specified by |prefix_bytes|.
-  This is in the form of {<full ref>: <gen num> ...}
+def get_config():
+  """Returns the number.* git config as {<lowercased key>: <value>}."""
+  ret = {}
+  try:
+    lines = run_git('config', '--get-regexp', r'^number\.').splitlines()
+  except CalledProcessError:  # no number.* keys at all
+    lines = []
+  for line in lines:
+    key, _, value = line.partition(' ')
+    ret[key] = value or 'true'
+  return ret
+
 
-  >>> get_num_tree('\x83\xb4')
-  {'\x83\xb4\xe3\xe4W\xf9J*\x8f/c\x16\xecD\xd1\x04\x8b\xa9qz': 169, ...}
+def lower_bound(buf, key, lo=0, hi=None):
+  """Returns the index of the first record in |buf| (a buffer of sorted
+  CHUNK_FMT records) whose hash is >= |key|."""
+  if hi is None:
+    hi = len(buf) / CHUNK_SIZE
+  klen = len(key)
+  while lo < hi:
+    mid = (lo + hi) / 2
+    off = mid * CHUNK_SIZE
+    if buf[off:off+klen] < key:
+      lo = mid + 1
+    else:
+      hi = mid
+  return lo
+
+
+def upper_bound(buf, key, lo=0, hi=None):
+  """Returns the index of the first record in |buf| (see |lower_bound|) whose
+  hash doesn't start with something <= |key|."""
+  if hi is None:
+    hi = len(buf) / CHUNK_SIZE
+  klen = len(key)
+  while lo < hi:
+    mid = (lo + hi) / 2
+    off = mid * CHUNK_SIZE
+    if buf[off:off+klen] <= key:
+      lo = mid + 1
+    else:
+      hi = mid
+  return lo
+
+
+def find_record(buf, key, lo=0, hi=None):
+  """Returns the number for |key| in |buf| (see |lower_bound|) or None."""
+  if hi is None:
+    hi = len(buf) / CHUNK_SIZE
+  idx = lower_bound(buf, key, lo, hi)
+  if idx < hi:
+    ref, num = struct.unpack_from(CHUNK_FMT, buf, idx * CHUNK_SIZE)
+    if ref == key:
+      return num
+  return None
+
+
+class NumTree(object):
+  """A compact {<full ref>: <gen num>} map.
+
+  Numbers are kept as one packed buffer of sorted CHUNK_FMT records (the
+  same layout as the leaf blobs, so a leaf is used as-is) which is binary
+  searched in place. New numbers go into a small insertion dict which is
+  merged into the buffer once it holds INSERT_LIMIT entries. That's ~24 bytes
+  per number, instead of a dict entry and a str object.
   """
-  ret = {}
-  ref = '%s:%s' % (REF, pathlify(prefix_bytes))
+  INSERT_LIMIT = 4096
 
-  p = subprocess.Popen(['git', 'cat-file', 'blob', ref],
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-  p.stderr.close()
-  raw = buffer(p.stdout.read())
-  for i in xrange(len(raw) / CHUNK_SIZE):
-    ref, num = struct.unpack_from(CHUNK_FMT, raw, i * CHUNK_SIZE)
-    ret[ref] = num
+  def __init__(self, records=''):
+    self._records = records
+    self._inserts = {}
 
+  def __len__(self):
+    return len(self._records) / CHUNK_SIZE + len(self._inserts)
+
+  def get(self, ref):
+    num = self._inserts.get(ref)
+    if num is None:
+      num = find_record(self._records, ref)
+    return num
+
+  def __setitem__(self, ref, num):
+    self._inserts[ref] = num
+    if len(self._inserts) >= self.INSERT_LIMIT:
+      self._merge()
+
+  def clear(self):
+    self._records = ''
+    self._inserts.clear()
+
+  def records(self):
+    """Returns all the numbers as a buffer of sorted CHUNK_FMT records."""
+    self._merge()
+    return self._records
+
+  def _merge(self):
+    if not self._inserts:
+      return
+    chunks = []
+    pos = 0
+    for ref, num in sorted(self._inserts.iteritems()):
+      idx = lower_bound(self._records, ref, pos)
+      chunks.append(self._records[pos*CHUNK_SIZE:idx*CHUNK_SIZE])
+      chunks.append(struct.pack(CHUNK_FMT, ref, num))
+      pos = idx
+    chunks.append(self._records[pos*CHUNK_SIZE:])
+    self._records = ''.join(chunks)
+    self._inserts.clear()
+
+
+PENDING = NumTree()  # numbers calculated by this process but not yet saved
+
+
+class NumCache(object):
+  """A memory-mapped, sorted copy of every number stored in REF.
+
+  The file lives at $GIT_DIR/number.cache and is laid out as a header, a
+  fanout table of 2**bits cumulative record counts (keyed on the leading
+  |bits| bits of the hash), and then every CHUNK_FMT record in hash order.
+  Lookups binary search the mapped file in place, so looking up a handful of
+  commits never unpacks whole leaves into dicts.
+
+  The header records which commit of REF the file was built from; a cache
+  that doesn't match the current REF (or the configured fanout) is rebuilt.
+  """
+
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self.bits, self.ref, self.count = struct.unpack_from(
+        CACHE_HEADER_FMT, self._map)
+    assert magic == CACHE_MAGIC
+    self._fanout = struct.unpack_from('!%dL' % (1 << self.bits), self._map,
+                                      CACHE_HEADER_SIZE)
+    self._records = buffer(self._map, CACHE_HEADER_SIZE + 4 * (1 << self.bits))
+
+  def get(self, ref):
+    bucket = struct.unpack('!H', ref[:2])[0] >> (16 - self.bits)
+    lo = self._fanout[bucket - 1] if bucket else 0
+    return find_record(self._records, ref, lo, self._fanout[bucket])
+
+  def close(self):
+    self._map.close()
+
+  @staticmethod
+  def build(path, ref, bits, inc=lambda: None):
+    """Writes a cache of the numbers in REF (at commit |ref|) to |path|.
+
+    Calls |inc| once per leaf read.
+    """
+    def write_records(f):
+      # Leaves are named by hash prefix and are each sorted, so walking them
+      # in name order yields every record in hash order.
+      for name, overlays in sorted(list_leaves().iteritems()):
+        f.write(read_leaf(name, overlays))
+        inc()
+    NumCache._write(path, ref, bits, write_records)
+
+  def update(self, path, ref, inc=lambda: None):
+    """Writes a cache for REF at commit |ref| to |path|, reading only the
+    leaves which changed since this cache was built and merging their new
+    records into this cache's.
+
+    Raises CalledProcessError if that isn't possible (e.g. REF was rewound).
+    """
+    new = []
+    diff = run_git('diff-tree', '-r', hexlify(self.ref), hexlify(ref))
+    for line in diff.splitlines():
+      _, _, _, obj, status_name = line.split(' ', 4)
+      status, name = status_name.split('\t', 1)
+      if status not in 'AM' and '.' not in name:
+        raise CalledProcessError(1, 'base leaf %s went away' % name)
+      if status in 'AM':
+        data = read_blob(obj)
+        for i in xrange(0, len(data), CHUNK_SIZE):
+          if self.get(data[i:i+20]) is None:
+            new.append(data[i:i+CHUNK_SIZE])
+        inc()
+    new.sort()
+
+    def write_records(f):
+      pos = 0
+      for record in new:
+        idx = lower_bound(self._records, record[:20], pos)
+        f.write(self._records[pos*CHUNK_SIZE:idx*CHUNK_SIZE])
+        f.write(record)
+        pos = idx
+      f.write(self._records[pos*CHUNK_SIZE:])
+    NumCache._write(path, ref, self.bits, write_records)
+
+  @staticmethod
+  def _write(path, ref, bits, write_records):
+    def write(f):
+      f.write('\0' * (CACHE_HEADER_SIZE + 4 * (1 << bits)))
+      write_records(f)
+      f.flush()
+
+      m = mmap.mmap(f.fileno(), 0)
+      records = buffer(m, CACHE_HEADER_SIZE + 4 * (1 << bits))
+      count = len(records) / CHUNK_SIZE
+      fanout = [lower_bound(records, struct.pack('!H', (b + 1) << (16 - bits)))
+                for b in xrange((1 << bits) - 1)] + [count]
+      del records
+      m.close()
+
+      f.seek(0)
+      f.write(struct.pack(CACHE_HEADER_FMT, CACHE_MAGIC, bits, ref, count))
+      f.write(struct.pack('!%dL' % len(fanout), *fanout))
+    write_atomically(path, write, 'w+b')
+
+
+@memoize_deco()
+def get_cache():
+  """Returns a NumCache in sync with REF, or None if the cache is disabled
+  (`git config number.cache false`) or REF doesn't exist yet.
+
+  The fanout is `git config number.cacheFanout` bits (0-16, default 8).
+  """
+  config = get_config()
+  if config.get('number.cache', 'true') == 'false':
+    return None
+  bits = int(config.get('number.cachefanout', DEFAULT_FANOUT_BITS))
+  assert 0 <= bits <= 16, 'number.cacheFanout must be between 0 and 16'
+  try:
+    ref = unhexlify(git_hash(REF))
+  except CalledProcessError:
+    return None
+
+  path = os.path.join(git_dir(), CACHE_FILE)
+  if os.path.exists(path):
+    cache = NumCache(path)
+    if cache.ref == ref and cache.bits == bits:
+      return cache
+    try:
+      if cache.bits == bits:
+        with StatusPrinter('Updating number cache: %d leaves') as inc:
+          cache.update(path, ref, inc)
+        return NumCache(path)
+    except CalledProcessError:
+      pass
+    finally:
+      cache.close()
+  with StatusPrinter('Rebuilding number cache: %d leaves') as inc:
+    NumCache.build(path, ref, bits, inc)
+  return NumCache(path)
+
+
+@memoize_deco()
+def list_leaves():
+  """Returns {<leaf path>: [<overlay path>, ...]} for every leaf in REF.
+
+  Overlays are listed oldest first.
+  """
+  ret = {}
+  for name in git_tree(REF, recurse=True) or ():
+    path, _, overlay = name.partition('.')
+    ret.setdefault(path, [])
+    if overlay:
+      ret[path].append(name)
+  for overlays in ret.itervalues():
+    overlays.sort(key=lambda o: int(o.rsplit('.', 1)[1]))
   return ret
 
 
+def read_blob(ref):
+  obj = cat_file().query(ref)
+  return obj[2] if obj else ''
+
+
+def sort_records(data):
+  """Sorts a buffer of CHUNK_FMT records by hash."""
+  return ''.join(sorted(data[i:i+CHUNK_SIZE]
+                        for i in xrange(0, len(data), CHUNK_SIZE)))
+
+
+def read_leaf(path, overlays=()):
+  """Returns the raw, sorted CHUNK_FMT records of leaf |path| in REF, with
+  its |overlays| merged in."""
+  data = read_blob('%s:%s' % (REF, path))
+  if overlays:
+    data = sort_records(data + ''.join(
+        read_blob('%s:%s' % (REF, o)) for o in overlays))
+  return data
+
+@memoize_deco()
+def get_num_tree(prefix_bytes):
+  """Return a NumTree of the leaf specified by |prefix_bytes|.
+
+  >>> get_num_tree('\x83\xb4').get(
+  ...     '\x83\xb4\xe3\xe4W\xf9J*\x8f/c\x16\xecD\xd1\x04\x8b\xa9qz')
+  169
+  """
+  path = pathlify(prefix_bytes)
+  return NumTree(read_leaf(path, list_leaves().get(path)))
+
+
 def intern_num_tree(tree):
-  """Transform a number tree (in the form returned by |get_num_tree|) into a
-  git blob.
+  """Transform a NumTree into a git blob.
 
   Returns the git blob hash.
 
-  >>> d = {'\x83\xb4\xe3\xe4W\xf9J*\x8f/c\x16\xecD\xd1\x04\x8b\xa9qz': 169}
-  >>> intern_num_tree(d)
+  >>> t = NumTree()
+  >>> t['\x83\xb4\xe3\xe4W\xf9J*\x8f/c\x16\xecD\xd1\x04\x8b\xa9qz'] = 169
+  >>> intern_num_tree(t)
   'c552317aa95ca8c3f6aae3357a4be299fbcb25ce'
   """
-  with tempfile.TemporaryFile() as f:
-    for k, v in sorted(tree.iteritems()):
-      f.write(struct.pack(CHUNK_FMT, k, v))
-    f.seek(0)
-    return git_intern_f(f)
+  return intern_records(tree.records())
+
+
+def intern_records(data):
+  """Writes |data| to git as a blob and returns its hash."""
+  return hash_object().write(data)
 
 
-@memoize_deco()
 def get_num(ref):
   """Takes a hash and returns the generation number for it or None."""
-  return get_num_tree(ref[:PREFIX_LEN]).get(ref)
+  num = PENDING.get(ref)
+  if num is not None:
+    return num
+  for run in SPILLS:
+    num = find_record(run, ref)
+    if num is not None:
+      return num
+  cache = get_cache()
+  if cache is None:
+    return get_num_tree(ref[:PREFIX_LEN]).get(ref)
+  return cache.get(ref)
 
 
 def set_num(ref, val):
@@ -68,111 +390,438 @@ def set_num(ref, val):
 
   This change will not be saved to the git repo until finalize() is called.
   """
-  prefix = ref[:PREFIX_LEN]
-  get_num_tree(prefix)[ref] = val
-  DIRTY_TREES[prefix] += 1
-  get_num.cache[ref,] = val
+  PENDING[ref] = val
   return val
 
 
-UPDATE_IDX_FMT = '100644 blob %s\t%s\0'
-def leaf_map_fn(prefix_tree):
-  pre, tree = prefix_tree
-  return UPDATE_IDX_FMT % (intern_num_tree(tree), pathlify(pre))
+def spill(records=None):
+  """Moves the numbers in PENDING (or the sorted CHUNK_FMT |records|) into a
+  new sorted run on disk."""
+  if records is None:
+    records = PENDING.records()
+    PENDING.clear()
+  if not records:
+    return
+  with tempfile.TemporaryFile() as f:
+    f.write(records)
+    f.flush()
+    SPILLS.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def iter_spilled_leaves():
+  """Yields (prefix, records) for every prefix in SPILLS, in order, with the
+  records for each prefix merged across all the runs."""
+  pos = [0] * len(SPILLS)
+  while True:
+    heads = [run[p*CHUNK_SIZE:p*CHUNK_SIZE+PREFIX_LEN]
+             for run, p in zip(SPILLS, pos) if p*CHUNK_SIZE < len(run)]
+    if not heads:
+      return
+    prefix = min(heads)
+    chunks = []
+    for i, run in enumerate(SPILLS):
+      end = upper_bound(run, prefix, pos[i])
+      chunks.append(run[pos[i]*CHUNK_SIZE:end*CHUNK_SIZE])
+      pos[i] = end
+    yield prefix, sort_records(''.join(chunks))
 
 
-def finalize(target):
-  """After calculating the generation number for |target|, call finalize to
-  save all our work to the git repository.
+UPDATE_IDX_FMT = '100644 blob %s\t%s\0'
+REMOVE_IDX_FMT = '0 %s\t%%s\0' % ('0' * 40)
+def leaf_map_fn(job):
+  """Returns the update-index lines which add the |new| records to leaf
+  |path| (which currently has |overlays|, or None if it doesn't exist).
+
+  Normally |new| just becomes one more overlay, so the cost is proportional
+  to the number of new commits. A brand new leaf, or one which has run out
+  of overlays, is compacted into a single base blob instead.
+  """
+  path, overlays, new = job
+  if overlays is None or len(overlays) >= OVERLAY_LIMIT:
+    data = sort_records(read_leaf(path, overlays) + new)
+    return UPDATE_IDX_FMT % (intern_records(data), path) + ''.join(
+        REMOVE_IDX_FMT % o for o in overlays or ())
+  n = int(overlays[-1].rsplit('.', 1)[1]) + 1 if overlays else 1
+  return UPDATE_IDX_FMT % (intern_records(new), '%s.%d' % (path, n))
+
+
+def finalize(targets):
+  """After calculating the generation numbers for |targets| (hex hashes),
+  call finalize to save all our work to the git repository.
   """
-  if not DIRTY_TREES:
+  spill()
+  if not SPILLS:
     return
 
-  msg = 'git-number Added %s numbers' % sum(DIRTY_TREES.itervalues())
+  msg = 'git-number Added %s numbers' % (
+      sum(len(run) for run in SPILLS) / CHUNK_SIZE)
 
-
-  idx = os.path.join(run_git('rev-parse', '--git-dir'), 'number.idx')
+  idx = os.path.join(git_dir(), 'number.idx')
   env = {'GIT_INDEX_FILE': idx}
 
-  with StatusPrinter('Finalizing: (%%d/%d)' % len(DIRTY_TREES)) as inc:
+  leaves = list_leaves()
+  jobs = ((pathlify(prefix), leaves.get(pathlify(prefix)), new)
+          for prefix, new in iter_spilled_leaves())
+
+  with StatusPrinter('Finalizing: %d leaves') as inc:
     run_git('read-tree', REF, env=env)
 
-    prefixes_trees = ((p, get_num_tree(p)) for p in sorted(DIRTY_TREES))
     updater = subprocess.Popen(['git', 'update-index', '-z', '--index-info'],
                                stdin=subprocess.PIPE, env=env)
 
-    with ScopedPool() as leaf_pool:
-      for item in leaf_pool.imap(leaf_map_fn, prefixes_trees):
-        updater.stdin.write(item)
-        inc()
+    # Leaves are small and blobs are hashed in-process, so this is cheaper
+    # done right here than shipped off to a pool of workers.
+    for job in jobs:
+      updater.stdin.write(leaf_map_fn(job))
+      inc()
 
     updater.stdin.close()
     updater.wait()
 
+    # Only the targets which aren't ancestors of each other need to be
+    # parents; that's all it takes to exclude them with ^REF next time.
+    heads = run_git('merge-base', '--independent', *targets).split()
+    parents = ['-p', git_hash(REF)]
+    for head in heads:
+      parents += ['-p', head]
     run_git('update-ref', REF,
-            run_git('commit-tree', '-m', msg,
-                    '-p', git_hash(REF), '-p', target,
-                    run_git('write-tree', env=env)))
+            run_git('commit-tree', '-m', msg, *(parents + [
+                    run_git('write-tree', env=env)])))
 
 
-def preload_tree(prefix):
-  return prefix, get_num_tree(prefix)
+def reset_state():
+  """Forgets everything loaded or calculated so far, e.g. because REF moved."""
+  for run in SPILLS:
+    run.close()
+  SPILLS[:] = []
+  PENDING.clear()
+  for cache in get_cache.cache.values():
+    cache.close()
+  for memo in (get_config, get_cache, list_leaves, get_num_tree):
+    memo.cache.clear()
 
 
-def resolve(target):
-  """Return the generation number for target.
+class Backend(object):
+  """The `number -backend` process built from number.go.
 
-  As a side effect, record any new calculated data to the git repository.
+  It parses rev-list batches, numbers them and holds the results, asking us
+  only for the numbers of parents outside of what it holds, and hands all it
+  holds back as sorted records on |flush|. See number.go for the protocol.
   """
-  num = get_num(target)
-  if num is not None:
-    return num
 
-  if git_tree(REF) is None:
-    empty = git_mktree({})
-    ref = run_git('commit-tree', '-m', 'Initial commit from git-number', empty)
-    run_git('update-ref', REF, ref)
+  def __init__(self, exe):
+    self._proc = subprocess.Popen([exe, '-backend'], stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE, close_fds=True)
+
+  def _readline(self):
+    line = self._proc.stdout.readline()
+    if not line:
+      raise CalledProcessError(self._proc.wait(), 'number -backend')
+    return line.split()
+
+  def add(self, lines):
+    """Numbers |lines| of `rev-list --parents` output.
+
+    Returns (<numbers held>, <number of the last line's commit>).
+    """
+    self._proc.stdin.write('B %d\n' % len(lines))
+    self._proc.stdin.writelines(lines)
+    self._proc.stdin.flush()
+    _, k = self._readline()
+    need = [self._proc.stdout.readline() for _ in xrange(int(k))]
+    self._proc.stdin.writelines(
+        '%d\n' % get_num(unhexlify(h.strip())) for h in need)
+    self._proc.stdin.flush()
+    _, held, last = self._readline()
+    return int(held), int(last)
+
+  def flush(self):
+    """Returns everything held as a buffer of sorted CHUNK_FMT records."""
+    self._proc.stdin.write('F\n')
+    self._proc.stdin.flush()
+    _, size = self._readline()
+    return self._proc.stdout.read(int(size))
+
+  def close(self):
+    self._proc.stdin.close()
+    self._proc.wait()
+
+
+def get_backend():
+  """Returns a Backend, or None if there is no `number` binary to use.
+
+  The binary is looked for next to this file (see number.go for how to build
+  it), or at `git config number.backend`; setting that to false disables it.
+  """
+  exe = get_config().get('number.backend')
+  if exe == 'false':
+    return None
+  if exe is None:
+    exe = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'number')
+  if not os.access(exe, os.X_OK):
+    return None
+  return Backend(exe)
+
+
+def _ranges(starts, ends):
+  """Returns the concatenation of numpy.arange(s, e) for each (s, e)."""
+  lengths = ends - starts
+  offsets = starts - numpy.cumsum(lengths) + lengths
+  return numpy.repeat(offsets, lengths) + numpy.arange(lengths.sum())
+
+
+def generations(batch):
+  """Returns the generation numbers of |batch|, a topologically ordered list
+  of (ref, [parent refs]), parents first.
+
+  Parents outside of the batch must already be numbered. Without numpy this
+  is just the obvious loop. With numpy, commits get dense ids and the parent
+  links within the batch become CSR arrays; then each wave of commits whose
+  parents are all numbered is computed with array operations at once. Once
+  the waves get narrow (e.g. long linear history) the rest is finished with
+  the loop, which is valid since the batch is already in topological order.
+  """
+  if numpy is None:
+    ret = []
+    nums = {}
+    for ref, pars in batch:
+      num = 0
+      for p in pars:
+        num = max(num, (nums[p] if p in nums else get_num(p)) + 1)
+      nums[ref] = num
+      ret.append(num)
+    return ret
+
+  ids = {ref: i for i, (ref, _) in enumerate(batch)}
+  base = []     # 1 + the max number of any parent outside the batch
+  indptr = [0]  # parents of commit i are indices[indptr[i]:indptr[i+1]]
+  indices = []
+  for ref, pars in batch:
+    num = 0
+    for p in pars:
+      i = ids.get(p)
+      if i is None:
+        num = max(num, get_num(p) + 1)
+      else:
+        indices.append(i)
+    base.append(num)
+    indptr.append(len(indices))
+
+  n = len(batch)
+  gen = numpy.array(base, dtype=numpy.int64)
+  indptr = numpy.array(indptr, dtype=numpy.int64)
+  indices = numpy.array(indices, dtype=numpy.int64)
+  child_of_edge = numpy.repeat(numpy.arange(n), numpy.diff(indptr))
+  # The same edges, grouped by parent instead.
+  order = numpy.argsort(indices, kind='mergesort')
+  children = child_of_edge[order]
+  child_ptr = numpy.searchsorted(indices[order], numpy.arange(n + 1))
+
+  waiting = numpy.diff(indptr)  # parents in the batch not yet numbered
+  done = numpy.zeros(n, dtype=bool)
+  wave = numpy.flatnonzero(waiting == 0)
+  while len(wave) >= MIN_WAVE:
+    edges = _ranges(indptr[wave], indptr[wave + 1])
+    numpy.maximum.at(gen, child_of_edge[edges], gen[indices[edges]] + 1)
+    done[wave] = True
+    kids = children[_ranges(child_ptr[wave], child_ptr[wave + 1])]
+    numpy.subtract.at(waiting, kids, 1)
+    kids = numpy.unique(kids)
+    wave = kids[waiting[kids] == 0]
+
+  gen = gen.tolist()
+  indptr = indptr.tolist()
+  indices = indices.tolist()
+  for i in numpy.flatnonzero(~done).tolist():
+    for j in indices[indptr[i]:indptr[i+1]]:
+      if gen[j] >= gen[i]:
+        gen[i] = gen[j] + 1
+  return gen
 
-  with ScopedPool() as pool:
-    available = pool.apply_async(git_tree, args=(REF,), kwds={'recurse': True})
-    preload = set()
-    rev_list = []
-
-    with StatusPrinter('Loading commits: %d') as inc:
-      for line in run_git('rev-list', '--topo-order', '--parents',
-                         '--reverse', hexlify(target), '^'+REF).splitlines():
-        toks = map(unhexlify, line.split())
-        rev_list.append((toks[0], toks[1:]))
-        preload.update(t[:PREFIX_LEN] for t in toks)
-        inc()
 
-    preload.intersection_update(
-      unhexlify(k.replace('/', ''))
-      for k in available.get().iterkeys()
-    )
-    preload.difference_update((x,) for x in get_num_tree.cache)
+def resolve(target):
+  """Return the generation number for target.
+
+  As a side effect, record any new calculated data to the git repository.
+  """
+  return resolve_many([target])[0]
 
-    if preload:
-      preload_iter = pool.imap_unordered(preload_tree, preload)
-      with StatusPrinter('Preloading nurbs: (%%d/%d)' % len(preload)) as inc:
-        for prefix, tree in preload_iter:
-          get_num_tree.cache[prefix,] = tree
-          inc()
 
-  get_num_tree.default_enabled = True
+def resolve_many(targets):
+  """Return the generation numbers for |targets|, in the same order.
 
+  As a side effect, record any new calculated data to the git repository.
+  All the targets which aren't numbered yet are numbered in one rev-list walk
+  and saved in one commit.
 
-  for ref, pars in rev_list:
-    num = set_num(ref, max(map(get_num, pars)) + 1 if pars else 0)
+  rev-list is streamed and numbered BATCH_SIZE commits at a time, by the Go
+  Backend if there is one and by |generations| otherwise. At most about
+  SPILL_SIZE new numbers are held in memory at once, so memory use doesn't
+  grow with the size of the history being numbered.
+  """
+  nums = map(get_num, targets)
+  missing = sorted(set(t for t, num in zip(targets, nums) if num is None))
+  if not missing:
+    return nums
 
-  finalize(hexlify(target))
+  if git_tree(REF) is None:
+    empty = git_mktree({})
+    ref = run_git('commit-tree', '-m', 'Initial commit from git-number', empty)
+    run_git('update-ref', REF, ref)
 
-  return num
+  cmd = ['git', 'rev-list', '--topo-order', '--parents', '--reverse',
+         '--stdin']
+  rev_list = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE)
+  rev_list.stdin.write(''.join(hexlify(t) + '\n' for t in missing))
+  rev_list.stdin.write('^%s\n' % REF)
+  rev_list.stdin.close()
+  lines = iter(rev_list.stdout.readline, '')
+  backend = get_backend()
+  with StatusPrinter('Numbering commits: %d') as inc:
+    while True:
+      batch = list(itertools.islice(lines, BATCH_SIZE))
+      if not batch:
+        break
+      if backend:
+        held, _ = backend.add(batch)
+        if held >= SPILL_SIZE:
+          spill(backend.flush())
+      else:
+        batch = [(toks[0], toks[1:])
+                 for toks in (map(unhexlify, line.split()) for line in batch)]
+        for (ref, _), num in zip(batch, generations(batch)):
+          set_num(ref, num)
+        if len(PENDING) >= SPILL_SIZE:
+          spill()
+      inc(len(batch))
+  if backend:
+    spill(backend.flush())
+    backend.close()
+  if rev_list.wait():
+    raise CalledProcessError(rev_list.returncode, cmd)
+
+  finalize(map(hexlify, missing))
+  nums = map(get_num, targets)
+  reset_state()
+  return nums
+
+
+def answer(committishes, err=None):
+  """Resolves |committishes| and returns the "<hash> <number>\\n" lines for
+  them. Things which aren't commits are reported on |err| (stderr by
+  default) and skipped."""
+  err = err or sys.stderr
+  targets = []
+  for committish in committishes:
+    try:
+      targets.append(unhexlify(git_hash(committish + '^{commit}')))
+    except CalledProcessError:
+      print >> err, '%r does not seem to be a valid commitish.' % committish
+  return ''.join('%s %d\n' % (hexlify(t), num)
+                 for t, num in zip(targets, resolve_many(targets)))
+
+
+def recv_all(conn):
+  chunks = []
+  for chunk in iter(lambda: conn.recv(1 << 16), ''):
+    chunks.append(chunk)
+  return ''.join(chunks)
+
+
+def serve(path):
+  """Answers queries on the unix socket at |path| until killed.
+
+  A query is a connection which sends committishes one per line, then shuts
+  down its sending side; it gets back what |answer| returns, then a NUL and
+  whatever |answer| had to report about bad committishes (or the error, if
+  answering failed). Everything loaded stays warm between queries, and is
+  dropped when REF moves.
+  """
+  def current_ref():
+    try:
+      return git_hash(REF)
+    except CalledProcessError:  # nothing numbered yet
+      return None
+
+  if os.path.exists(path):
+    os.unlink(path)
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.bind(path)
+  server.listen(16)
+  # Make `kill` clean up the socket too.
+  signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+  ref = None
+  try:
+    while True:
+      conn, _ = server.accept()
+      try:
+        committishes = recv_all(conn).split()
+        if current_ref() != ref:
+          reset_state()
+        err = StringIO()
+        try:
+          out = answer(committishes, err)
+          ref = current_ref()
+        except Exception:
+          # Don't let one bad query take the server down; whatever was half
+          # loaded gets dropped, and the client gets the error.
+          out = ''
+          err.write(traceback.format_exc())
+          reset_state()
+          ref = None
+        conn.sendall(out + '\0' + err.getvalue())
+      except socket.error:
+        pass  # the client went away
+      finally:
+        conn.close()
+  finally:
+    server.close()
+    os.unlink(path)
+
+
+def query(path, committishes):
+  """Asks the server at |path| about |committishes|.
+
+  Returns its answer, or None if there's no server listening there. Bad
+  committishes are reported on stderr, as |answer| would.
+  """
+  conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    conn.connect(path)
+  except socket.error:
+    return None
+  try:
+    conn.sendall(''.join(c + '\n' for c in committishes))
+    conn.shutdown(socket.SHUT_WR)
+    out, _, err = recv_all(conn).partition('\0')
+    sys.stderr.write(err)
+    return out
+  finally:
+    conn.close()
 
 
 def main():
+  """Usage:
+    number.py [<committish>]  Prints the generation number of <committish>.
+    number.py --stdin         Reads committishes from stdin, one per line,
+                              and prints "<hash> <number>" for each. Uses the
+                              server if one is running.
+    number.py --serve         Runs a server on $GIT_DIR/number.sock which
+                              keeps the numbers warm between --stdin queries.
+  """
+  sock = os.path.join(git_dir(), SOCKET_FILE)
   try:
-    print resolve(parse_one_committish())
+    if '--serve' in sys.argv:
+      serve(sock)
+    elif '--stdin' in sys.argv:
+      committishes = sys.stdin.read().split()
+      ret = query(sock, committishes)
+      if ret is None:
+        ret = answer(committishes)
+      sys.stdout.write(ret)
+    else:
+      print resolve(parse_one_committish())
   except KeyboardInterrupt:
     pass
 
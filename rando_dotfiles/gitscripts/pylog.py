@@ -1,56 +1,212 @@
 #!/usr/bin/env python
+import os
+import re
+import select
+import subprocess
 import sys
+import threading
+
+from common import GIT_EXE, RefSnapshot, run_git
+
+BRIGHT = '\x1b[1m'
+CYAN = '\x1b[36m'
+GREEN = '\x1b[32m'
+BLUEBAK = '\x1b[44m'
+MAGENTA = '\x1b[35m'
+RED = '\x1b[31m'
+RESET = '\x1b[m'
+
+HEAD_MARKER = BLUEBAK+BRIGHT+'*'
+
+# A green ' (<refs>)' decoration plus the 4 byte color reset after it, along
+# with the rest of its line before it (where the graph's '*' is).
+DECORATION = re.compile(
+    r'^([^\n]*?)' + re.escape(GREEN+' (') + r'([^)\n]*)\)[^\n]{0,4}',
+    re.MULTILINE)
+
+# What `pylog <log args>` asks git log for. The hash between the NULs is
+# swapped for the commit's decoration.
+LOG_FORMAT = '%C(yellow)%h%C(reset)%x00%H%x00 %s'
+LOG_DECORATION = re.compile(r'^([^\n\0]*)\0([0-9a-f]{40})\0', re.MULTILINE)
+
+BLOCK_SIZE = 1 << 16
+MAX_BUFFERED = 1 << 20
+
+
+class RefColors(object):
+  """The color of every branch and tag name, and the names of every commit
+  with refs pointing at it, looked up from a RefSnapshot which loads in the
+  background, so that output doesn't wait on it until the first decoration
+  turns up."""
+
+  def __init__(self):
+    self._colors = None
+    self._names = None
+    self._thread = threading.Thread(target=self._load)
+    self._thread.start()
+
+  def _load(self):
+    refs = RefSnapshot()
+    colors = {}
+    for refname in refs.hashes:
+      if refname.startswith('refs/tags/'):
+        colors[refname[len('refs/tags/'):]] = MAGENTA+BRIGHT
+    for branch in refs.branches():
+      colors[branch] = GREEN+BRIGHT
+    colors[refs.current_branch()] = CYAN+BRIGHT
+    names = {}
+    # Ordered like git's own decorations: branches, remotes, then tags.
+    for prefix in ('refs/heads/', 'refs/remotes/', 'refs/tags/'):
+      for refname in sorted(refs.hashes):
+        if refname.startswith(prefix):
+          commit = refs.peeled.get(refname, refs.hashes[refname])
+          names.setdefault(commit, []).append(refname[len(prefix):])
+    names.setdefault(refs.git_hash('HEAD'), []).insert(0, 'HEAD')
+    self._names = names
+    self._colors = colors
+
+  def _wait(self):
+    if self._colors is None:
+      self._thread.join()
+      if self._colors is None:  # couldn't read the refs; decorate nothing
+        self._colors, self._names = {}, {}
+
+  def get(self, name):
+    self._wait()
+    return self._colors.get(name)
+
+  def names(self, commit):
+    """Returns the names of the refs pointing at |commit| (a hash)."""
+    self._wait()
+    return self._names.get(commit, ())
+
+
+def render(names, colors):
+  """Returns the colored '(<names>)' for a decoration ('' if it's only HEAD),
+  and whether HEAD was among |names|."""
+  head = False
+  colored = []
+  for name in names:
+    if name == 'HEAD':
+      head = True
+      continue
+    color = colors.get(name)
+    colored.append(color+name+RESET if color else RED+name)
+  if not colored:
+    return '', head
+  return '(%s)' % ((GREEN+', ').join(colored)+GREEN), head
+
+
+def filter_stream(fd, out, transform):
+  """Copies everything read from |fd| to |out|, passing it through
+  |transform| a block of whole lines at a time.
+
+  Output is buffered while there's more input ready and flushed whenever
+  there isn't, so the first screenful shows up as soon as it's read.
+  """
+  if sys.platform.startswith('win'):
+    idle = lambda: True  # select only works on sockets there
+  else:
+    idle = lambda: not select.select([fd], [], [], 0)[0]
+  pending = []
+  buffered = 0
+  partial = ''
+  while True:
+    data = os.read(fd, BLOCK_SIZE)
+    if data:
+      block, nl, partial = (partial + data).rpartition('\n')
+      block += nl
+    else:
+      block, partial = partial, ''
+    if block:
+      block = transform(block)
+      pending.append(block)
+      buffered += len(block)
+    if not data or buffered >= MAX_BUFFERED or idle():
+      out.write(''.join(pending))
+      out.flush()
+      pending = []
+      buffered = 0
+    if not data:
+      break
+
+
+def pager():
+  """Returns the process paging the output like git log's would be (with
+  the same defaults), or None if stdout isn't a terminal or there's no
+  pager configured."""
+  if not sys.stdout.isatty():
+    return None
+  cmd = run_git('var', 'GIT_PAGER')
+  if not cmd or cmd == 'cat':
+    return None
+  env = os.environ.copy()
+  env.setdefault('LESS', 'FRX')
+  env.setdefault('LV', '-c')
+  return subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, env=env)
+
+
+def log(args):
+  """Runs `git log --graph <args>` decorated from RefColors, instead of
+  having git decorate it and then recoloring that.
+
+  git log only runs as far ahead of the pager as the pipes allow, so big
+  logs are read a page at a time.
+  """
+  colors = RefColors()
+
+  def decorate(match):
+    before, commit = match.groups()
+    decoration, head = render(colors.names(commit), colors)
+    if head:
+      before = before.replace('*', HEAD_MARKER, 1)
+    if not decoration:
+      return before
+    return '%s %s%s%s' % (before, GREEN, decoration, RESET)
+
+  proc = subprocess.Popen(
+      (GIT_EXE, 'log', '--graph', '--color=always', '--format='+LOG_FORMAT)
+      + tuple(args), stdout=subprocess.PIPE)
+  pager_proc = pager()
+  out = pager_proc.stdin if pager_proc else sys.stdout
+  try:
+    filter_stream(proc.stdout.fileno(), out,
+                  lambda block: LOG_DECORATION.sub(decorate, block))
+    ret = proc.wait()
+  except (EnvironmentError, KeyboardInterrupt):
+    # The pager quit early; nobody wants the rest of the log.
+    proc.kill()
+    proc.wait()
+    ret = 0
+  if pager_proc:
+    try:
+      pager_proc.stdin.close()
+    except EnvironmentError:
+      pass
+    pager_proc.wait()
+  return ret
+
+
+def main(argv):
+  if len(argv) > 1 or sys.stdin.isatty():
+    return log(argv[1:])
+
+  colors = RefColors()
+
+  def decorate(match):
+    before, names = match.groups()
+    decoration, head = render(names.split(', '), colors)
+    if head:
+      before = before.replace('*', HEAD_MARKER, 1)
+    return '%s%s %s' % (before, GREEN, decoration+' ' if decoration else '')
 
-from common import current_branch, branches, tags
-
-def main():
-  BRIGHT = '\x1b[1m'
-  CYAN = '\x1b[36m'
-  GREEN = '\x1b[32m'
-  BLUEBAK = '\x1b[44m'
-  MAGENTA = '\x1b[35m'
-  RED = '\x1b[31m'
-  RESET = '\x1b[m'
-  current = current_branch()
-  all_branches = set(branches())
-  if current in all_branches:
-    all_branches.remove(current)
-  all_tags = set(tags())
   try:
-    for line in sys.stdin.xreadlines():
-      start = line.find(GREEN+' (')
-      end   = line.find(')', start)
-      if start != -1 and end != -1:
-        start += len(GREEN) + 2
-        branch_list = line[start:end].split(', ')
-        branches_str = ''
-        if branch_list:
-          colored_branches = []
-          head_marker = ''
-          for b in branch_list:
-            if b == "HEAD":
-              head_marker = BLUEBAK+BRIGHT+'*'
-              continue
-            if b == current:
-              colored_branches.append(CYAN+BRIGHT+b+RESET)
-              current = None
-            elif b in all_branches:
-              colored_branches.append(GREEN+BRIGHT+b+RESET)
-              all_branches.remove(b)
-            elif b in all_tags:
-              colored_branches.append(MAGENTA+BRIGHT+b+RESET)
-              all_tags.remove(b)
-            else:
-              colored_branches.append(RED+b)
-            branches_str = '(%s) ' % ((GREEN+", ").join(colored_branches)+GREEN)
-          line = "%s%s%s" % (line[:start-1], branches_str, line[end+5:])
-          if head_marker:
-            line = line.replace('*', head_marker, 1)
-      sys.stdout.write(line)
-  except:
+    filter_stream(sys.stdin.fileno(), sys.stdout,
+                  lambda block: DECORATION.sub(decorate, block))
+  except (EnvironmentError, KeyboardInterrupt):
     pass
   return 0
 
 
 if __name__ == '__main__':
-  sys.exit(main())
+  sys.exit(main(sys.argv))
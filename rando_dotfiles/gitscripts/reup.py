@@ -6,10 +6,11 @@ from pprint import pprint
 from collections import namedtuple
 
 from bclean import bclean
-from squash import squash
-from common import CalledProcessError, run_git, VERBOSE, upstream
-from common import branches, current_branch, get_or_create_merge_base_tag
-from common import clean_refs, git_hash
+from common import CalledProcessError, run_git, VERBOSE, branches
+from common import get_or_create_merge_bases, clean_refs, git_hash
+from common import clean_legacy_refs
+from common import BranchGraph, ScopedPool, replay, merge_trees, make_commit
+from common import tree_of, run_jobs, worktree_branches
 
 RebaseRet = namedtuple('TryRebaseRet', 'success message')
 
@@ -23,74 +24,125 @@ def rebase(parent, start, branch, abort=False):
     return RebaseRet(False, cpe.output)
 
 
-def clean_branch(branch, parent, starting_ref):
-  if (git_hash(parent) != git_hash(starting_ref)
-      and git_hash(branch) != git_hash(starting_ref)):
-    print 'Rebasing:', branch
-
-    # Try a plain rebase first
-    if rebase(parent, starting_ref, branch, abort=True).success:
-      return
-
-    # Maybe squashing will help?
-    print "Failed! Attempting to squash", branch, "...",
-    squash_branch = branch+"_squash_attempt"
-    run_git('checkout', '-b', squash_branch)
-    squash()
-
-    squash_ret = rebase(parent, starting_ref, squash_branch, abort=True)
-    run_git('checkout', branch)
-    run_git('branch', '-D', squash_branch)
-
-    if squash_ret.success:
-      print 'Success!'
-      squash()
-    final_rebase = rebase(parent, starting_ref, branch)
-    assert final_rebase.success == squash_ret.success
-
-    if not squash_ret.success:
-      print squash_ret.message
-      print 'Failure :('
-      print 'Your working copy is in mid-rebase. Please completely resolve and'
-      print 'run `git reup` again.'
-      sys.exit(1)
+def needs_rebase(branch, parent, starting_ref):
+  return (git_hash(parent) != git_hash(starting_ref)
+          and git_hash(branch) != git_hash(starting_ref))
+
+
+def replay_branch(branch, parent, starting_ref):
+  """Rebases |branch| onto |parent| without touching the worktree (see
+  |replay|), squashing it if it doesn't apply cleanly as it is.
+
+  Returns whether that worked (or wasn't needed); if not, |branch| is left
+  alone.
+  """
+  if not needs_rebase(branch, parent, starting_ref):
+    return True
+  print 'Rebasing:', branch
+  head, base, onto = map(git_hash, (branch, starting_ref, parent))
+  new = replay(onto, base, head)
+  if new is None:
+    # Merging the whole branch at once is exactly what squashing it gives.
+    squashed = merge_trees(tree_of(base), tree_of(onto), tree_of(head))
+    if squashed is None:
+      print 'Conflicts, even squashed:', branch
+      return False
+    print 'Conflicts, so squashed:', branch
+    if squashed == tree_of(onto):
+      new = onto  # everything in it is upstream already
+    else:
+      new = make_commit(squashed, [onto], head)
+  run_git('update-ref', '-m', 'reup: rebase onto %s' % parent,
+          'refs/heads/' + branch, new, head)
+  return True
+
+
+def topo_order(graph, roots):
+  """Returns |roots| and all their descendants in the BranchGraph |graph|,
+  parents before children."""
+  ret = list(roots)
+  for branch in ret:
+    ret.extend(graph.children.get(branch, ()))
+  return ret
+
+
+def parallel_rebase(graph, starting_refs, checked_out=()):
+  """Rebases every tracking branch in the BranchGraph |graph| onto its
+  upstream with replay_branch, parents first, with branches whose parents
+  are done rebasing in parallel.
+
+  Branches which don't rebase cleanly are left alone, along with everything
+  downstream of them. Returns the ones which failed. Branches in
+  |checked_out| are skipped, though their downstreams still get rebased.
+  """
+  def rebase_branch(branch):
+    if branch in checked_out:
+      print 'Skipping %s: checked out in %s' % (branch, checked_out[branch])
+      return True
+    return replay_branch(branch, graph.parents[branch], starting_refs[branch])
+
+  failed = []
+  def rebased(branch, ok):
+    if ok:
+      return graph.children.get(branch, ())
+    failed.append(branch)
+
+  ready = [b for root in graph.roots for b in graph.children.get(root, ())]
+  with ScopedPool(kind='threads') as pool:
+    run_jobs(pool, rebase_branch, ready, rebased)
+  return sorted(failed)
 
 
 def main():
   if '--clean' in sys.argv:
     clean_refs()
+    clean_legacy_refs()
     return 0
 
-  orig_branch = current_branch()
-  if orig_branch == 'HEAD':
-    orig_branch = git_hash('HEAD')
-
   if 'origin' in run_git('remote').splitlines():
     run_git('fetch', 'origin', stderr=None)
   else:
     run_git('svn', 'fetch', stderr=None)
-  branch_tree = {}
-  for branch in branches():
-    parent = upstream(branch)
-    if not parent:
+
+  graph = BranchGraph.load()
+  orig_branch = graph.refs.current_branch()
+  if orig_branch == 'HEAD':
+    orig_branch = graph.refs.git_hash('HEAD')
+
+  branch_tree = graph.parents
+  for branch in graph.refs.branches():
+    if branch not in branch_tree:
       print 'Skipping %s: No upstream specified' % branch
-      continue
-    branch_tree[branch] = parent
 
-  starting_refs = {}
-  for branch, parent in branch_tree.iteritems():
-    starting_refs[branch] = get_or_create_merge_base_tag(branch, parent)
+  starting_refs = get_or_create_merge_bases(branch_tree.iteritems())
 
   if VERBOSE:
     pprint(branch_tree)
     pprint(starting_refs)
 
-  # XXX There is a more efficient way to do this, but for now...
-  while branch_tree:
-    this_pass = [i for i in branch_tree.items() if i[1] not in branch_tree]
-    for branch, parent in this_pass:
-      clean_branch(branch, parent, starting_refs[branch])
-      del branch_tree[branch]
+  # Branches are rebased by moving their refs, so don't leave one checked
+  # out under the index. This doesn't touch any files, and the worktree is
+  # only updated once, by the checkout at the end.
+  run_git('checkout', '-q', '--detach')
+
+  # Like `git rebase`, leave branches checked out in other worktrees alone.
+  checked_out = worktree_branches()
+  failed = parallel_rebase(graph, starting_refs, checked_out)
+  # Conflicts have to be resolved by hand, in the worktree.
+  for branch in topo_order(graph, failed):
+    if branch in checked_out:
+      print 'Skipping %s: checked out in %s' % (branch, checked_out[branch])
+      continue
+    if not needs_rebase(branch, branch_tree[branch], starting_refs[branch]):
+      continue
+    print 'Rebasing:', branch
+    ret = rebase(branch_tree[branch], starting_refs[branch], branch)
+    if not ret.success:
+      print ret.message
+      print 'Failure :('
+      print 'Your working copy is in mid-rebase. Please completely resolve and'
+      print 'run `git reup` again.'
+      sys.exit(1)
 
   clean_refs()
 
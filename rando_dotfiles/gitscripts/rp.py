@@ -2,7 +2,7 @@
 import sys
 
 from common import upstream, current_branch, branches, run_git
-from common import get_or_create_merge_base_tag, VERBOSE
+from common import get_or_create_merge_base, VERBOSE
 
 def main(argv):
   assert len(argv) == 2, "Must supply new parent"
@@ -12,7 +12,7 @@ def main(argv):
   assert branch != 'HEAD', 'Must be on the branch you want to reparent'
   assert cur_parent != new_parent
 
-  get_or_create_merge_base_tag(branch, cur_parent)
+  get_or_create_merge_base(branch, cur_parent)
 
   print "Reparenting %s to track %s (was %s)" % (branch, new_parent, cur_parent)
   run_git('branch', '--set-upstream-to', new_parent, branch)
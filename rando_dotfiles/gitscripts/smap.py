@@ -1,15 +1,46 @@
 #!/usr/bin/env python
-import collections
 import sys
+import time
 
 from colorama import Fore, Style
 
-from common import current_branch, branches, upstream, git_hash, git_hashes
+from common import BranchGraph
 
+AGE_UNITS = (
+  ('year', 365*24*60*60),
+  ('month', 30*24*60*60),
+  ('week', 7*24*60*60),
+  ('day', 24*60*60),
+  ('hour', 60*60),
+  ('minute', 60),
+)
 
-def print_branch(cur, cur_hash, branch, branch_hashes, par_map, branch_map,
-                 depth=0):
-  branch_hash = branch_hashes[branch]
+
+def age(seconds):
+  for unit, size in AGE_UNITS:
+    if seconds >= size:
+      count = seconds // size
+      return '%d %s%s ago' % (count, unit, 's' if count > 1 else '')
+  return 'just now'
+
+
+def annotation(branch, graph, now):
+  """Returns how far |branch| is ahead of and behind its upstream, and how
+  long ago it was last committed to, as far as they're known."""
+  parts = []
+  ahead, behind = graph.ahead_behind().get(branch, (0, 0))
+  counts = [fmt % n for fmt, n in (('ahead %d', ahead), ('behind %d', behind))
+            if n]
+  if counts:
+    parts.append('[%s]' % ', '.join(counts))
+  commit_time = graph.refs.commit_time(branch)
+  if commit_time is not None:
+    parts.append(age(max(0, now - commit_time)))
+  return ' '.join(parts)
+
+
+def print_branch(cur, cur_hash, branch, graph, now):
+  branch_hash = graph.refs.git_hash(branch)
   if branch.startswith('origin'):
     color = Fore.RED
   elif branch_hash == cur_hash:
@@ -22,33 +53,23 @@ def print_branch(cur, cur_hash, branch, branch_hashes, par_map, branch_map,
   else:
     color += Style.NORMAL
 
-  print color + "  "*depth + branch + (" *" if branch == cur else "")
-  for child in par_map.pop(branch, ()):
-    print_branch(cur, cur_hash, child, branch_hashes, par_map, branch_map,
-                 depth=depth+1)
+  line = "  "*graph.depth[branch] + branch + (" *" if branch == cur else "")
+  extra = annotation(branch, graph, now)
+  if extra:
+    line += "  " + Style.DIM + extra
+  print color + line + Style.RESET_ALL
+  for child in graph.children.get(branch, ()):
+    print_branch(cur, cur_hash, child, graph, now)
 
 
 def main(argv):
   assert len(argv) == 1, "No arguments expected"
-  branch_map = {}
-  par_map = collections.defaultdict(list)
-  for branch in branches():
-    par = upstream(branch)
-    branch_map[branch] = par
-    par_map[par].append(branch)
-
-  current = current_branch()
-  hashes = git_hashes(current, *branch_map.keys())
-  current_hash = hashes[0]
-  par_hashes = {k: hashes[i+1] for i, k in enumerate(branch_map.iterkeys())}
-  while par_map:
-    for parent in par_map:
-      if parent not in branch_map:
-        if parent not in par_hashes:
-          par_hashes[parent] = git_hash(parent)
-        print_branch(current, current_hash, parent, par_hashes, par_map,
-                     branch_map)
-        break
+  graph = BranchGraph.load()
+  current = graph.refs.current_branch()
+  current_hash = graph.refs.git_hash(current)
+  now = int(time.time())
+  for root in graph.roots:
+    print_branch(current, current_hash, root, graph, now)
 
 
 if __name__ == '__main__':
@@ -1,16 +1,26 @@
 #!/usr/bin/env python
 import sys
 
-from common import current_branch, upstream, get_or_create_merge_base_tag
-from common import run_git, clean_refs
+from common import current_branch, upstream, get_or_create_merge_base
+from common import run_git, clean_refs, squash_commit, CalledProcessError
 
 
 def squash():
   branch = current_branch()
   parent = upstream(branch)
-  merge_base = get_or_create_merge_base_tag(branch, parent)
-  run_git('reset', '--soft', merge_base)
-  run_git('commit', '-a', '-C', 'HEAD@{1}')
+  merge_base = get_or_create_merge_base(branch, parent)
+  try:
+    run_git('update-index', '-q', '--refresh')
+    run_git('diff-index', '--quiet', 'HEAD')
+  except CalledProcessError:
+    # There are uncommitted changes to fold in as well.
+    run_git('reset', '--soft', merge_base)
+    run_git('commit', '-a', '-C', 'HEAD@{1}')
+    return
+  # The squashed commit has the same tree as HEAD, so moving the branch to it
+  # leaves the index and worktree as they are.
+  run_git('update-ref', '-m', 'squash', 'HEAD',
+          squash_commit('HEAD', merge_base))
 
 def main():
   squash()
@@ -0,0 +1,66 @@
+#!/bin/bash
+# Checks that number.py numbers a history exactly the same with and without
+# the number.go backend, by comparing the refs/number/commits trees the two
+# produce. Each numbers part of the history first and then the rest, and then
+# does it all again a few commits at a time, so that numbers get looked up
+# across runs, batches and spills as well. Needs go on $PATH.
+set -e
+
+HERE=$(cd "$(dirname "$0")" && pwd)
+PYTHON=${PYTHON:-python}
+TMP=$(mktemp -d)
+trap 'rm -rf "$TMP"' EXIT
+
+(cd "$HERE" && go build -o "$TMP/number" number.go)
+
+# number.py, but reading and spilling a handful of commits at a time.
+cat > "$TMP/small.py" <<EOF
+import sys
+sys.path.insert(0, '$HERE')
+import number
+number.BATCH_SIZE = 16
+number.SPILL_SIZE = 50
+number.main()
+EOF
+
+# A history with branches, merges (including an octopus) and a few hundred
+# commits.
+git init -q "$TMP/repo"
+cd "$TMP/repo"
+c() { git commit -q --allow-empty -m "$1"; }
+c root
+for i in $(seq 40); do c "master $i"; done
+for b in a b c; do
+  git checkout -q -b $b master~$((RANDOM % 30))
+  for i in $(seq 60); do c "$b $i"; done
+done
+git checkout -q master
+git merge -q --no-edit a
+for i in $(seq 20); do c "master more $i"; done
+git merge -q --no-edit b c > /dev/null
+for i in $(seq 20); do c "master last $i"; done
+
+# Numbers HEAD~50 and then HEAD from scratch, with the backend $1 and the
+# script $2, and prints the tree that comes out.
+number() {
+  git update-ref -d refs/number/commits
+  rm -f "$(git rev-parse --git-dir)/number.cache"
+  git config number.backend "$1"
+  for rev in HEAD~50 HEAD; do
+    "$PYTHON" "$2" $rev > /dev/null
+  done
+  git rev-parse 'refs/number/commits^{tree}'
+}
+
+py=$(number false "$HERE/number.py")
+for run in "number.go:$TMP/number:$HERE/number.py" \
+           "small python:false:$TMP/small.py" \
+           "small number.go:$TMP/number:$TMP/small.py"; do
+  IFS=: read name backend script <<< "$run"
+  tree=$(number "$backend" "$script")
+  if [ "$py" != "$tree" ]; then
+    echo "FAIL: python numbered to $py, $name to $tree"
+    exit 1
+  fi
+done
+echo "PASS: $py"